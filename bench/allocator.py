@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark of the vectorized bandwidth Allocator against the per-request computation in
+Request.get_target_bandwidth(), on synthetic requests spread over a set of sites
+
+Usage: python bench/allocator.py [--n_requests 100000] [--n_sites 40]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dmm.allocator import Allocator
+
+class FakeSite:
+    def __init__(self, rse_name, total_uplink_capacity):
+        self.rse_name = rse_name
+        self.total_uplink_capacity = total_uplink_capacity
+        self.prio_sums = {}
+        self.all_prios_sum = 0
+
+class FakeRequest:
+    def __init__(self, src_site, dst_site, priority, theoretical_bandwidth):
+        self.src_site = src_site
+        self.dst_site = dst_site
+        self.priority = priority
+        self.best_effort = (priority == 0)
+        self.theoretical_bandwidth = theoretical_bandwidth
+
+def get_target_bandwidth(request):
+    """Same computation as Request.get_target_bandwidth() for the fake objects above"""
+    if request.best_effort:
+        return 0
+    src_site, dst_site = request.src_site, request.dst_site
+    pair_sum = src_site.prio_sums[dst_site.rse_name]
+    max_bandwidth = min(
+        src_site.total_uplink_capacity*(pair_sum/src_site.all_prios_sum),
+        dst_site.total_uplink_capacity*(dst_site.prio_sums[src_site.rse_name]/dst_site.all_prios_sum),
+        request.theoretical_bandwidth
+    )
+    return int(max_bandwidth*request.priority/pair_sum)
+
+def make_requests(n_requests, n_sites, seed=42):
+    random.seed(seed)
+    sites = [FakeSite(f"SITE{i:03d}", random.choice([1e4, 4e4, 1e5, 4e5])) for i in range(n_sites)]
+    requests = []
+    for _ in range(n_requests):
+        src_site, dst_site = random.sample(sites, 2)
+        priority = random.choice([0, 1, 2, 3, 5, 8])
+        request = FakeRequest(src_site, dst_site, priority, random.choice([1e4, 4e4, 1e5]))
+        for site, partner in [(src_site, dst_site), (dst_site, src_site)]:
+            site.all_prios_sum += priority
+            site.prio_sums[partner.rse_name] = site.prio_sums.get(partner.rse_name, 0) + priority
+        requests.append(request)
+    return requests
+
+def best_of(n_repeats, func, *args):
+    best = None
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best*1e3, result
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="bandwidth allocation benchmark")
+    cli.add_argument(
+        "--n_requests", type=int, default=100000,
+        help="number of synthetic requests (default: 100000)"
+    )
+    cli.add_argument(
+        "--n_sites", type=int, default=40,
+        help="number of synthetic sites (default: 40)"
+    )
+    cli.add_argument(
+        "--n_repeats", type=int, default=5,
+        help="number of repetitions; the best time is reported (default: 5)"
+    )
+    args = cli.parse_args()
+
+    requests = make_requests(args.n_requests, args.n_sites)
+    print(f"{args.n_requests} requests over {args.n_sites} sites")
+
+    scalar_ms, scalar_targets = best_of(
+        args.n_repeats, lambda: [get_target_bandwidth(r) for r in requests]
+    )
+    print(f"{'per-request loop':>24}: {scalar_ms:8.2f} ms")
+
+    snapshot_ms, snapshot = best_of(args.n_repeats, Allocator.snapshot, requests)
+    print(f"{'snapshot':>24}: {snapshot_ms:8.2f} ms")
+    for policy in Allocator.POLICIES:
+        compute = Allocator.proportional if policy == "proportional" else Allocator.max_min
+        compute_ms, targets = best_of(args.n_repeats, compute, *snapshot)
+        print(f"{policy + ' (vectorized)':>24}: {compute_ms:8.2f} ms")
+        if policy == "proportional":
+            n_mismatched = sum(a != b for a, b in zip(scalar_targets, targets.tolist()))
+            print(f"{'':>24}  {n_mismatched} targets differ from the per-request loop")
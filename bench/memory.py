@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Benchmark of the resident size of DMM.requests, comparing the current Request with a
+replica of the previous representation (dict-backed attributes, the full list of transfer
+IDs, a list of history tuples and a Prometheus client per request)
+
+The sites are built from canned discovery results, so no SENSE endpoint is needed; run
+from the directory that contains config.yaml.
+
+Usage: python bench/memory.py [--n_requests 10000 100000] [--n_transfer_ids 100]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dmm.request import Request
+from dmm.site import Site
+
+class CannedDiscovery:
+    """Stand-in for a DiscoveryCache that already holds every site"""
+    def get(self, rse_name):
+        return {
+            "time": time.time(),
+            "sense_name": f"urn:{rse_name}",
+            "uplink_capacity": 100000,
+            "ipv6_pool": []
+        }
+
+class LegacyPrometheus:
+    def __init__(self):
+        self.prometheus_addr = "http://localhost:9090"
+        self.dev_map = {}
+
+class LegacyRequest:
+    """Replica of the attributes that Request used to keep"""
+    def __init__(self, rule_id, src_site, dst_site, transfer_ids, priority,
+                 n_bytes_total, n_transfers_total):
+        self.request_id = Request.id(rule_id, src_site.rse_name, dst_site.rse_name)
+        self.rule_id = rule_id
+        self.src_site = src_site
+        self.dst_site = dst_site
+        self.transfer_ids = transfer_ids
+        self.priority = priority
+        self.n_bytes_total = n_bytes_total
+        self.n_bytes_transferred = 0
+        self.n_transfers_total = n_transfers_total
+        self.n_transfers_submitted = 0
+        self.n_transfers_finished = 0
+        self.best_effort = (self.priority == 0)
+        self.link_is_open = False
+        self.src_ipv6 = ""
+        self.dst_ipv6 = ""
+        self.bandwidth = 0
+        self.history = [(time.time(), self.bandwidth, 0, "init")]
+        self.prometheus = LegacyPrometheus()
+        self.sense_link_id = ""
+        self.theoretical_bandwidth = -1
+
+def measure(request_class, n_requests, n_transfer_ids, n_updates, sites):
+    """Return the memory (in bytes) still allocated after building n_requests requests"""
+    gc.collect()
+    tracemalloc.start()
+    requests = {}
+    for request_i in range(n_requests):
+        src_site, dst_site = sites[request_i % 2], sites[1 - request_i % 2]
+        # As in the preparer payload, the transfer IDs arrive as a fresh list of strings
+        request_attr = {
+            "transfer_ids": [f"{request_i:016x}{id_i:016x}" for id_i in range(n_transfer_ids)],
+            "priority": request_i % 5,
+            "n_bytes_total": 10**9,
+            "n_transfers_total": n_transfer_ids
+        }
+        request = request_class(f"{request_i:032x}", src_site, dst_site, **request_attr)
+        for update_i in range(n_updates):
+            if request_class is LegacyRequest:
+                request.history.append((time.time(), 1000, -1, "adjusting for priority update"))
+            else:
+                request.history.append(time.time(), 1000, -1, "adjusting for priority update")
+        requests[request.request_id] = request
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del requests
+    return size
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="DMM.requests memory benchmark")
+    cli.add_argument(
+        "--n_requests", type=int, nargs="+", default=[10000, 100000],
+        help="numbers of requests to build (default: 10000 100000)"
+    )
+    cli.add_argument(
+        "--n_transfer_ids", type=int, default=100,
+        help="number of transfer IDs per request (default: 100)"
+    )
+    cli.add_argument(
+        "--n_updates", type=int, default=10,
+        help="number of history entries appended to each request (default: 10)"
+    )
+    cli.add_argument(
+        "--sites", type=str, nargs=2, default=["XRD1", "XRD2"],
+        help="two RSEs configured in config.yaml (default: XRD1 XRD2)"
+    )
+    args = cli.parse_args()
+
+    sites = [Site(rse_name, discovery_cache=CannedDiscovery()) for rse_name in args.sites]
+    print(f"{args.n_transfer_ids} transfer IDs and {args.n_updates} updates per request")
+    print(f"{'requests':>10} | {'before [MB]':>11} | {'after [MB]':>10} | {'per request [B]':>19} | ratio")
+    for n_requests in args.n_requests:
+        before = measure(LegacyRequest, n_requests, args.n_transfer_ids, args.n_updates, sites)
+        after = measure(Request, n_requests, args.n_transfer_ids, args.n_updates, sites)
+        per_request = f"{before//n_requests} -> {after//n_requests}"
+        print(
+            f"{n_requests:>10} | {before/1e6:11.1f} | {after/1e6:10.1f} | {per_request:>19} | "
+            f"{before/after:4.1f}x"
+        )
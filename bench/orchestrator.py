@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the Orchestrator dispatch loop: CPU burned while idle and the latency
+between Orchestrator.put and the job starting on a worker thread. The busy-polling loop
+that the Orchestrator used before it became event-driven is kept here for comparison.
+
+Usage: python bench/orchestrator.py [--idle_time 2] [--n_jobs 1000]
+"""
+import argparse
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Event, Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dmm.orchestrator import Orchestrator
+
+class BusyPollOrchestrator:
+    """Previous Orchestrator implementation, which polls its jobs in a tight loop"""
+    def __init__(self, n_workers=4):
+        self.pool = ThreadPool(processes=n_workers)
+        self.queued = {}
+        self.active = {}
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = Thread(target=self.__start)
+        self.thread.start()
+
+    def __start(self):
+        while not self.stop_event.is_set():
+            finished_jobs = []
+            for job_name, worker in self.active.items():
+                if worker.ready():
+                    finished_jobs.append(job_name)
+            while len(finished_jobs) > 0:
+                self.active.pop(finished_jobs.pop())
+            self.lock.acquire()
+            for job_name, job_queue in self.queued.items():
+                if job_name not in self.active.keys():
+                    worker_func, job_args = job_queue.pop()
+                    self.active[job_name] = self.pool.apply_async(worker_func, job_args)
+                    if len(job_queue) == 0:
+                        finished_jobs.append(job_name)
+            while len(finished_jobs) > 0:
+                self.queued.pop(finished_jobs.pop())
+            self.lock.release()
+
+    def stop(self):
+        self.pool.close()
+        self.pool.terminate()
+        self.stop_event.set()
+        self.thread.join()
+
+    def put(self, job_name, worker_func, job_args):
+        self.lock.acquire()
+        if job_name in self.queued.keys():
+            self.queued[job_name].insert(0, (worker_func, job_args))
+        else:
+            self.queued[job_name] = [(worker_func, job_args)]
+        self.lock.release()
+
+def record_start(start_times, job_i):
+    start_times[job_i] = time.perf_counter()
+
+def measure_idle_cpu(orchestrator, idle_time):
+    """Return the fraction of a core used by the process while the orchestrator is idle"""
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    time.sleep(idle_time)
+    return (time.process_time() - cpu_start)/(time.perf_counter() - wall_start)
+
+def measure_latency(orchestrator, n_jobs, job_name=None):
+    """Return the submit-to-start latencies (in microseconds) of n_jobs trivial jobs"""
+    put_times = [0]*n_jobs
+    start_times = [None]*n_jobs
+    for job_i in range(n_jobs):
+        put_times[job_i] = time.perf_counter()
+        orchestrator.put(job_name or f"job_{job_i}", record_start, (start_times, job_i))
+        # Space the jobs out so that each one sees an otherwise idle orchestrator
+        time.sleep(0.001)
+    deadline = time.time() + 30
+    while None in start_times and time.time() < deadline:
+        time.sleep(0.01)
+    latencies = sorted(
+        (start - put)*1e6 for put, start in zip(put_times, start_times) if start is not None
+    )
+    return latencies
+
+def percentile(values, pct):
+    return values[min(int(len(values)*pct/100), len(values) - 1)]
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Orchestrator dispatch microbenchmark")
+    cli.add_argument(
+        "--idle_time", type=float, default=2,
+        help="seconds spent measuring idle CPU usage (default: 2)"
+    )
+    cli.add_argument(
+        "--n_jobs", type=int, default=1000,
+        help="number of jobs used to measure submit-to-start latency (default: 1000)"
+    )
+    cli.add_argument(
+        "-n", "--n_workers", type=int, default=4,
+        help="number of orchestrator workers (default: 4)"
+    )
+    args = cli.parse_args()
+
+    for label, orchestrator_cls in [("busy-poll", BusyPollOrchestrator), ("event-driven", Orchestrator)]:
+        orchestrator = orchestrator_cls(n_workers=args.n_workers)
+        idle_cpu = measure_idle_cpu(orchestrator, args.idle_time)
+        latencies = measure_latency(orchestrator, args.n_jobs)
+        orchestrator.stop()
+        print(
+            f"{label:>12}: idle CPU {100*idle_cpu:5.1f}% of a core | "
+            f"submit-to-start latency [us] "
+            f"p50 {percentile(latencies, 50):8.1f}, "
+            f"p99 {percentile(latencies, 99):8.1f}, "
+            f"max {latencies[-1]:8.1f} ({len(latencies)}/{args.n_jobs} started)"
+        )
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Load benchmark of the DMM control plane: replay a trace of Rucio daemon messages (as
+recorded with `trace_file` in config.yaml) against the DMM handlers, with SENSE and
+Prometheus stubbed out, and report the handler throughput and latencies, the orchestrator
+queue depth and the number of SENSE calls
+
+The stubbed SENSE calls take --sense_latency seconds each, and each site gets the IPv6
+blocks listed for it in config.yaml; run from the directory that contains config.yaml.
+The discovery cache, database, trace file and history spill directory in config.yaml are
+ignored, so that a replay never touches the state of a real DMM.
+Blocks that config.yaml maps to the best effort address of their site (as it does for the
+XRD test sites) are given a stub address of their own, so that they can be allocated.
+Without a trace, a synthetic one can be generated with --synthetic; its rules last long
+enough for their links to be flushed by the batcher, staged and provisioned at the chosen
+speed. Note: when messages are sent back to back (--speed 0), rules are finished before
+their batch of link updates is flushed, so that no link is staged; the report says so.
+
+Usage: python bench/replay.py --trace dmm_trace.jsonl [--speed 10] [--sense_latency 0.05]
+       python bench/replay.py --synthetic 200 [--sites XRD1 XRD2 XRD3 XRD4]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from threading import Thread, Event, Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmm.sense_api as sense_api
+import dmm.sense_aio as sense_aio
+import dmm.prometheus as prometheus
+from dmm.config import Config, DMMSection, SiteSection, get_config
+from dmm.dmm import DMM
+
+SENSE_CALLS = {}
+SENSE_CALLS_LOCK = Lock()
+
+def stub_sense_api(latency):
+    """Replace the SENSE queries in dmm.sense_api, and the link operations of its asyncio 
+    counterpart in dmm.sense_aio, with stubs that only count calls"""
+    instance_ids = itertools.count()
+    def count(name):
+        with SENSE_CALLS_LOCK:
+            SENSE_CALLS[name] = SENSE_CALLS.get(name, 0) + 1
+    def stub(name, result=None):
+        def stubbed(*args, **kwargs):
+            count(name)
+            time.sleep(latency)
+            return result(*args) if callable(result) else result
+        return stubbed
+    def stub_async(name, result=None):
+        async def stubbed(*args, **kwargs):
+            count(name)
+            await asyncio.sleep(latency)
+            return result(*args) if callable(result) else result
+        return stubbed
+    sense_api.get_uri = stub("get_uri", lambda rse_name, *args: f"urn:{rse_name}")
+    sense_api.get_uplink_capacity = stub("get_uplink_capacity", 100000.)
+    sense_api.get_ipv6_pool = stub(
+        "get_ipv6_pool", lambda uri: list(get_config().site(uri[4:]).ipv6_pool.keys())
+    )
+    sense_api.get_link_status = stub("get_link_status", "CREATE - READY")
+    link_operations = {
+        "stage_link": lambda *args: (f"instance-{next(instance_ids)}", 40000.),
+        "provision_link": None,
+        "reprovision_link": lambda *args: f"instance-{next(instance_ids)}",
+        "delete_link": None
+    }
+    for name, result in link_operations.items():
+        setattr(sense_api, name, stub(name, result))
+        setattr(sense_aio, name, stub_async(name, result))
+
+def stub_dmm_config():
+    """Ignore the discovery cache, database, trace file and history spill directory in 
+    config.yaml, so that the replayed DMM neither reads nor writes them"""
+    dmm = Config.dmm.fget
+    overrides = {"discovery_cache": "", "database": "", "trace_file": "", "history_spill_dir": ""}
+    Config.dmm = property(lambda config: DMMSection({**dmm(config), **overrides}))
+
+def stub_site_config():
+    """
+    Give each IPv6 block that config.yaml maps to the best effort address of its site a
+    distinct stub address; otherwise, DMM never moves such a block to the free pool, so no 
+    link is ever staged
+    """
+    site = Config.site
+    def stubbed(config, rse_name):
+        site_config = site(config, rse_name)
+        if site_config is None:
+            return None
+        ipv6_pool = {
+            block: f"[{block.split('/')[0]}1]:1094" if ipv6 == site_config.best_effort_ipv6 else ipv6
+            for block, ipv6 in site_config.ipv6_pool.items()
+        }
+        return SiteSection({**site_config, "ipv6_pool": ipv6_pool})
+    Config.site = stubbed
+
+class StubPrometheus:
+    """Prometheus client that reports no traffic"""
+    def get_transmit_counters(self, start_time, end_time, devices, rse_names, 
+                              max_points=1000):
+        return {}
+
+    def get_device(self, ipv6):
+        return ("stub", "stub")
+
+    def get_average_throughput(self, ipv6, rse_name, start_time, end_time):
+        return 0.
+
+def synthesize(n_rules, rse_names, min_duration=5, seed=42):
+    """Return a trace in which each rule is prepared, submitted and finished in turn, each 
+    lasting between min_duration and min_duration + 25 seconds"""
+    random.seed(seed)
+    trace = []
+    for rule_i in range(n_rules):
+        src_rse_name, dst_rse_name = random.sample(rse_names, 2)
+        rule_id = f"rule{rule_i:06d}"
+        rse_pair_id = f"{src_rse_name}&{dst_rse_name}"
+        priority = random.choice([1, 2, 3, 5])
+        n_transfers = random.randint(1, 100)
+        start = rule_i*0.1
+        trace.append({"time": start, "daemon": "PREPARER", "payload": {rule_id: {rse_pair_id: {
+            "transfer_ids": [f"{rule_id}_{i}" for i in range(n_transfers)],
+            "priority": priority,
+            "n_bytes_total": n_transfers*10**9,
+            "n_transfers_total": n_transfers
+        }}}})
+        trace.append({"time": start + 1, "daemon": "SUBMITTER", "payload": {rule_id: {rse_pair_id: {
+            "priority": priority,
+            "n_transfers_submitted": n_transfers
+        }}}})
+        trace.append({"time": start + min_duration + random.uniform(0, 25), "daemon": "FINISHER", "payload": {rule_id: {rse_pair_id: {
+            "n_transfers_finished": n_transfers,
+            "n_bytes_transferred": n_transfers*10**9
+        }}}})
+    trace.sort(key=lambda message: message["time"])
+    return trace
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(q*len(values)), len(values) - 1)]
+
+def replay(dmm, trace, speed):
+    """Send each message of the trace to its handler at its (accelerated) time; as with the 
+    DMM listener, each daemon waits for one message to be handled before sending the next. 
+    If the speed is 0, the messages are instead sent one at a time, in order
+
+    Returns the latency of each handler call and the number of failed calls, per daemon, 
+    the orchestrator queue depth samples, and the times at which all messages were handled 
+    and all link jobs were finished
+    """
+    handlers = {
+        "PREPARER": dmm.preparer_handler,
+        "SUBMITTER": dmm.submitter_handler,
+        "FINISHER": dmm.finisher_handler
+    }
+    latencies = {daemon: [] for daemon in handlers}
+    n_failed = {daemon: 0 for daemon in handlers}
+    queue_depths = []
+    done = Event()
+    def sample_queue_depth():
+        while not done.wait(timeout=0.01):
+            with dmm.orchestrator.lock:
+                queue_depths.append(sum(len(jobs) for jobs in dmm.orchestrator.queued.values()))
+    sampler = Thread(target=sample_queue_depth, daemon=True)
+    sampler.start()
+
+    t0 = trace[0]["time"] if trace else 0
+    start = time.perf_counter()
+    def send(daemons):
+        for message in trace:
+            daemon = message["daemon"]
+            if daemon not in daemons:
+                continue
+            if speed > 0:
+                delay = (message["time"] - t0)/speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            send_time = time.perf_counter()
+            try:
+                handlers[daemon](message["payload"])
+            except Exception:
+                n_failed[daemon] += 1
+            latencies[daemon].append(time.perf_counter() - send_time)
+    if speed > 0:
+        senders = [Thread(target=send, args=([daemon],)) for daemon in handlers]
+    else:
+        senders = [Thread(target=send, args=(list(handlers),))]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    handled = time.perf_counter() - start
+    # Wait for the last batch of link updates to be flushed, dispatched and finished
+    while True:
+        if not dmm.batcher.idle():
+            time.sleep(0.01)
+            continue
+        with dmm.orchestrator.lock:
+            if not dmm.orchestrator.queued and not dmm.orchestrator.active:
+                break
+        time.sleep(0.01)
+    drained = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    return latencies, n_failed, queue_depths, handled, drained
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="DMM record-and-replay load benchmark")
+    cli.add_argument(
+        "--trace", type=str, default="",
+        help="JSONL trace of Rucio daemon messages recorded by DMM"
+    )
+    cli.add_argument(
+        "--synthetic", type=int, default=0,
+        help="replay a synthetic trace with this many rules instead"
+    )
+    cli.add_argument(
+        "--sites", type=str, nargs="+", default=["XRD1", "XRD2", "XRD3", "XRD4"],
+        help="RSEs configured in config.yaml used by the synthetic trace"
+    )
+    cli.add_argument(
+        "--speed", type=float, default=0,
+        help="replay speed relative to the trace; 0 (default) sends messages back to back"
+    )
+    cli.add_argument(
+        "--sense_latency", type=float, default=0.05,
+        help="seconds taken by each stubbed SENSE call (default: 0.05)"
+    )
+    cli.add_argument(
+        "-n", "--n_workers", type=int, default=4,
+        help="number of orchestrator worker threads (default: 4)"
+    )
+    args = cli.parse_args()
+
+    if args.trace:
+        with open(args.trace, "r") as f_in:
+            trace = [json.loads(line) for line in f_in if line.strip()]
+    elif args.synthetic > 0:
+        # Finish each rule only once its link has had time to be flushed by the batcher, 
+        # then staged and provisioned, at the chosen speed
+        batch_max_latency = max(get_config().dmm.batch_max_latency, get_config().dmm.batch_window)
+        link_latency = batch_max_latency + 2*args.sense_latency + 1
+        trace = synthesize(args.synthetic, args.sites, min_duration=max(5, args.speed*link_latency))
+    else:
+        cli.error("either --trace or --synthetic is required")
+
+    stub_sense_api(args.sense_latency)
+    stub_site_config()
+    stub_dmm_config()
+    prometheus.PROMETHEUS = StubPrometheus()
+    dmm = DMM(n_workers=args.n_workers)
+    # The handlers are called directly, without a listener, so there is nothing to restore
+    dmm.restored.set()
+    latencies, n_failed, queue_depths, handled, drained = replay(dmm, trace, args.speed)
+    dmm.stop()
+
+    print(f"{len(trace)} messages handled in {handled:0.2f}s ({len(trace)/handled:0.1f} msg/s)")
+    print(f"orchestrator drained after {drained:0.2f}s")
+    print(f"{'daemon':>10} | {'calls':>6} | {'failed':>6} | {'p50 [ms]':>8} | {'p90 [ms]':>8} | {'p99 [ms]':>8} | {'max [ms]':>8}")
+    for daemon, values in latencies.items():
+        print(
+            f"{daemon:>10} | {len(values):6d} | {n_failed[daemon]:6d} | "
+            f"{1e3*percentile(values, 0.5):8.1f} | "
+            f"{1e3*percentile(values, 0.9):8.1f} | {1e3*percentile(values, 0.99):8.1f} | "
+            f"{1e3*max(values, default=0):8.1f}"
+        )
+    avg_depth = sum(queue_depths)/max(len(queue_depths), 1)
+    print(f"orchestrator queue depth: avg {avg_depth:0.1f}, max {max(queue_depths, default=0)}")
+    print("SENSE calls: " + ", ".join(f"{name} {n}" for name, n in sorted(SENSE_CALLS.items())))
+    if not SENSE_CALLS.get("stage_link"):
+        print(
+            "WARNING: no link was staged, so no link operation was measured; every rule "
+            "finished before its link was opened (pace the messages with --speed)"
+        )
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Benchmark of the per-call latency of dmm.sense_api with and without client pooling
+
+This talks to the SENSE endpoint configured in ~/.sense-o-auth.yaml, which should be a
+local stand-in (see .sense-o-auth.yaml.sim) rather than a production orchestrator. Run
+from the directory that contains config.yaml.
+
+Usage: python bench/sense_api.py --rse_name T2_US_SDSC [--n_calls 50] [--links]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import dmm.sense_api as sense_api
+
+def run_discovery(rse_name, n_calls):
+    for _ in range(n_calls):
+        uri = sense_api.get_uri(rse_name, regex=f"^{rse_name}$")
+        sense_api.get_uplink_capacity(uri)
+        sense_api.get_ipv6_pool(uri)
+
+def run_links(rse_name, n_calls):
+    uri = sense_api.get_uri(rse_name, regex=f"^{rse_name}$")
+    src_ipv6, dst_ipv6 = sense_api.get_ipv6_pool(uri)[:2]
+    for call_i in range(n_calls):
+        alias = f"bench_{call_i}"
+        instance_uuid, _ = sense_api.stage_link(uri, uri, src_ipv6, dst_ipv6, alias=alias)
+        sense_api.provision_link(instance_uuid, uri, uri, src_ipv6, dst_ipv6, 1000, alias=alias)
+        sense_api.delete_link(instance_uuid)
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="SENSE client pooling benchmark")
+    cli.add_argument(
+        "--rse_name", type=str, required=True,
+        help="RSE known to the SENSE endpoint, used for discovery queries"
+    )
+    cli.add_argument(
+        "--n_calls", type=int, default=50,
+        help="number of discovery (and link) cycles per mode (default: 50)"
+    )
+    cli.add_argument(
+        "--links", action="store_true",
+        help="also stage, provision and delete links"
+    )
+    args = cli.parse_args()
+
+    results = {}
+    for pooled in [False, True]:
+        sense_api.POOL_CLIENTS = pooled
+        sense_api.get_call_stats(reset=True)
+        start_time = time.perf_counter()
+        run_discovery(args.rse_name, args.n_calls)
+        if args.links:
+            run_links(args.rse_name, args.n_calls)
+        elapsed = time.perf_counter() - start_time
+        results[pooled] = (elapsed, sense_api.get_call_stats(reset=True))
+
+    print(f"{'call':>22} | {'unpooled [ms]':>13} | {'pooled [ms]':>11} | speed-up")
+    unpooled_stats, pooled_stats = results[False][1], results[True][1]
+    for name, stats in unpooled_stats.items():
+        unpooled_ms = 1e3*stats["avg_time"]
+        pooled_ms = 1e3*pooled_stats[name]["avg_time"]
+        print(f"{name:>22} | {unpooled_ms:13.2f} | {pooled_ms:11.2f} | {unpooled_ms/pooled_ms:6.1f}x")
+    print(f"{'total wall time [s]':>22} | {results[False][0]:13.2f} | {results[True][0]:11.2f} |")
@@ -0,0 +1,121 @@
+import numpy as np
+
+class Allocator:
+    """
+    Compute the bandwidth provision of every link in one vectorized pass over a consistent
+    snapshot of the requests and their sites
+
+    Policies:
+        proportional: the policy implemented by Request.get_target_bandwidth(); each site
+                      splits its uplink between its partners in proportion to their summed
+                      priorities, and each pair of sites splits its share between its
+                      requests in proportion to their priorities
+        max-min:      priority-weighted max-min fair allocation of the site uplinks, where
+                      each link is also capped by its theoretical bandwidth
+    """
+    POLICIES = ("proportional", "max-min")
+
+    def __init__(self, policy="proportional"):
+        if policy not in Allocator.POLICIES:
+            raise ValueError(f"unknown allocation policy '{policy}'")
+        self.policy = policy
+
+    @staticmethod
+    def snapshot(requests):
+        """Return the arrays describing a list of requests and the sites they connect
+
+        Returns (site capacities, source site indices, destination site indices,
+        priorities, theoretical bandwidths, best effort flags); theoretical bandwidths
+        that are not known yet (the link has not been staged) are negative
+        """
+        site_indices = {}
+        capacities = []
+        def site_index(site):
+            if site.rse_name not in site_indices:
+                site_indices[site.rse_name] = len(capacities)
+                capacities.append(site.total_uplink_capacity)
+            return site_indices[site.rse_name]
+
+        n_requests = len(requests)
+        src = np.fromiter((site_index(r.src_site) for r in requests), np.int64, n_requests)
+        dst = np.fromiter((site_index(r.dst_site) for r in requests), np.int64, n_requests)
+        priorities = np.fromiter((r.priority for r in requests), np.float64, n_requests)
+        theoretical = np.fromiter(
+            (r.theoretical_bandwidth for r in requests), np.float64, n_requests
+        )
+        best_effort = np.fromiter((r.best_effort for r in requests), bool, n_requests)
+        return np.array(capacities, np.float64), src, dst, priorities, theoretical, best_effort
+
+    def allocate(self, requests):
+        """Return an array of the target bandwidth (in Mb/s) of each request
+
+        A target of -1 means that the target can only be computed once the theoretical
+        bandwidth of the link is known
+        """
+        if len(requests) == 0:
+            return np.zeros(0, np.int64)
+        snapshot = Allocator.snapshot(requests)
+        if self.policy == "proportional":
+            return Allocator.proportional(*snapshot)
+        else:
+            return Allocator.max_min(*snapshot)
+
+    @staticmethod
+    def proportional(capacities, src, dst, priorities, theoretical, best_effort):
+        n_sites = len(capacities)
+        # A request between a site and itself is counted twice, as in Site.add_request
+        weights = priorities*np.where(src == dst, 2, 1)
+        # Denominator of the uplink fraction: sum of all priorities at each site
+        site_sums = np.bincount(src, priorities, n_sites) + np.bincount(dst, priorities, n_sites)
+        # Numerator of the uplink fraction: sum of priorities between each pair of sites
+        pairs = np.minimum(src, dst)*n_sites + np.maximum(src, dst)
+        pair_sums = np.bincount(pairs, weights, n_sites*n_sites)[pairs]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            max_bandwidths = np.minimum(
+                capacities[src]*(pair_sums/site_sums[src]),
+                capacities[dst]*(pair_sums/site_sums[dst])
+            )
+            max_bandwidths = np.where(
+                theoretical >= 0, np.minimum(max_bandwidths, theoretical), max_bandwidths
+            )
+            targets = max_bandwidths*(priorities/pair_sums)
+        targets = np.where(~np.isfinite(targets), 0, targets).astype(np.int64)
+        targets = np.where(theoretical < 0, -1, targets)
+        # Best effort links are never staged, so their theoretical bandwidth is never known
+        return np.where(best_effort, 0, targets)
+
+    @staticmethod
+    def max_min(capacities, src, dst, priorities, theoretical, best_effort):
+        n_sites = len(capacities)
+        allocations = np.zeros(len(src), np.float64)
+        remaining = capacities.copy()
+        caps = np.where(theoretical >= 0, theoretical, np.inf)
+        # Links that have not been allocated yet; shrinks as links are frozen
+        active = np.flatnonzero(~best_effort & (priorities > 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            while len(active) > 0:
+                active_src, active_dst = src[active], dst[active]
+                weights = priorities[active]
+                site_weights = (
+                    np.bincount(active_src, weights, n_sites) 
+                    + np.bincount(active_dst, weights, n_sites)
+                )
+                site_levels = np.where(site_weights > 0, remaining/site_weights, np.inf)
+                # Level (bandwidth per unit priority) at which the first site saturates
+                level = site_levels.min()
+                # Links that reach their cap before any site saturates get their cap
+                frozen = caps[active]/weights <= level
+                if frozen.any():
+                    fixed = caps[active][frozen]
+                else:
+                    # Otherwise, the links through the bottleneck sites are fixed at this level
+                    bottlenecks = site_levels <= level + abs(level)*1e-9
+                    frozen = bottlenecks[active_src] | bottlenecks[active_dst]
+                    fixed = level*weights[frozen]
+                allocations[active[frozen]] = fixed
+                remaining -= (
+                    np.bincount(active_src[frozen], fixed, n_sites) 
+                    + np.bincount(active_dst[frozen], fixed, n_sites)
+                )
+                active = active[~frozen]
+        return np.where(np.isfinite(allocations), allocations, 0).astype(np.int64)
@@ -0,0 +1,106 @@
+import logging
+import time
+from threading import Thread, Event, Lock, Condition
+
+class Batcher:
+    """
+    Gather the link updates requested by several handler calls and pass them to a callback
+    as a single batch once no new update has arrived for `window` seconds, or at the latest
+    `max_latency` seconds after the first update of the batch
+
+    The callback is called as callback(msgs, changed_sites), where msgs is the list of
+    distinct update messages and changed_sites is the union of the sites that changed (None
+    if any update concerned all sites). If window is 0, updates are passed on immediately.
+    """
+    def __init__(self, callback, window=0, max_latency=0):
+        self.callback = callback
+        self.window = window
+        self.max_latency = max(max_latency, window)
+        self.msgs = []
+        self.changed_sites = set()
+        self.first_put = None
+        self.last_put = None
+        self.n_puts = 0
+        self.n_batches = 0
+        # Whether a batch has been taken from the queue but not yet passed to the callback
+        self.flushing = False
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.__stop_event = Event()
+        if self.window > 0:
+            self.thread = Thread(target=self.__start, daemon=True)
+            self.thread.name = "BatchThread"
+            self.thread.start()
+
+    def __start(self):
+        logging.debug(f"Batcher started with a {self.window}s window")
+        while not self.__stop_event.is_set():
+            with self.condition:
+                # Sleep until the first update of a batch arrives
+                self.condition.wait_for(
+                    lambda: self.first_put is not None or self.__stop_event.is_set()
+                )
+                # Extend the window with every new update, up to the maximum latency
+                while not self.__stop_event.is_set():
+                    deadline = min(
+                        self.last_put + self.window,
+                        self.first_put + self.max_latency
+                    )
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout=timeout)
+                if self.__stop_event.is_set():
+                    break
+                msgs, changed_sites, n_puts = self.msgs, self.changed_sites, self.n_puts
+                self.__reset()
+                self.flushing = True
+            logging.debug(f"flushing {n_puts} batched updates")
+            try:
+                self.__flush(msgs, changed_sites)
+            finally:
+                with self.condition:
+                    self.flushing = False
+
+    def __reset(self):
+        self.msgs = []
+        self.changed_sites = set()
+        self.first_put = None
+        self.last_put = None
+        self.n_puts = 0
+
+    def __flush(self, msgs, changed_sites):
+        self.n_batches += 1
+        try:
+            self.callback(msgs, changed_sites)
+        except Exception as e:
+            logging.error(f"batched update failed, dumping error\n{e}")
+
+    def put(self, msg, changed_sites=None):
+        """Add an update to the current batch"""
+        if self.window <= 0:
+            self.__flush([msg], changed_sites)
+            return
+        with self.condition:
+            now = time.time()
+            if self.first_put is None:
+                self.first_put = now
+            self.last_put = now
+            self.n_puts += 1
+            if msg not in self.msgs:
+                self.msgs.append(msg)
+            if changed_sites is None or self.changed_sites is None:
+                self.changed_sites = None
+            else:
+                self.changed_sites.update(changed_sites)
+            self.condition.notify()
+
+    def idle(self):
+        """Return True if no update is waiting in a batch or being flushed"""
+        with self.condition:
+            return self.first_put is None and not self.flushing
+
+    def stop(self):
+        with self.condition:
+            self.__stop_event.set()
+            self.condition.notify()
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import logging
+from threading import Thread, Lock
+import dmm.sense_api as sense_api
+
+class DiscoveryCache:
+    """
+    Cache of the SENSE discovery results for each Rucio RSE (SENSE URI, uplink capacity and
+    IPv6 pool), kept in memory and persisted to a JSON file so that it survives restarts
+
+    Entries older than the TTL are still returned, but trigger a refresh in the background
+    """
+    def __init__(self, path="discovery_cache.json", ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = Lock()
+        if self.path and os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as f_in:
+                    self.entries = json.load(f_in)
+                logging.debug(f"loaded {len(self.entries)} sites from {self.path}")
+            except (OSError, ValueError) as e:
+                logging.warning(f"could not load discovery cache {self.path} - {e}")
+
+    @staticmethod
+    def discover(rse_name):
+        """Query SENSE for the discovery results of a given Rucio RSE"""
+        sense_name = sense_api.get_uri(rse_name, regex=f"^{rse_name}$")
+        return {
+            "time": time.time(),
+            "sense_name": sense_name,
+            "uplink_capacity": sense_api.get_uplink_capacity(sense_name),
+            "ipv6_pool": sense_api.get_ipv6_pool(sense_name)
+        }
+
+    def get(self, rse_name):
+        """Return the discovery results for a given Rucio RSE, querying SENSE on a miss"""
+        with self.lock:
+            entry = self.entries.get(rse_name)
+            stale = entry is not None and time.time() - entry["time"] > self.ttl
+            if stale and rse_name not in self.refreshing:
+                self.refreshing.add(rse_name)
+                refresh_thread = Thread(
+                    target=self.__background_refresh, args=(rse_name,), daemon=True
+                )
+                refresh_thread.name = f"CacheThread-{rse_name}"
+                refresh_thread.start()
+        if entry is None:
+            entry = self.refresh(rse_name)
+        return entry
+
+    def refresh(self, rse_name):
+        """Query SENSE for the discovery results of a given Rucio RSE and cache them"""
+        try:
+            entry = DiscoveryCache.discover(rse_name)
+        finally:
+            with self.lock:
+                self.refreshing.discard(rse_name)
+        with self.lock:
+            self.entries[rse_name] = entry
+            self.save()
+        logging.debug(f"refreshed discovery cache for {rse_name}")
+        return entry
+
+    def __background_refresh(self, rse_name):
+        try:
+            self.refresh(rse_name)
+        except Exception as e:
+            logging.warning(f"could not refresh discovery cache for {rse_name} - {e}")
+
+    def invalidate(self, rse_name=None):
+        """Drop the cached results for a given Rucio RSE, or for every RSE if none is given"""
+        with self.lock:
+            if rse_name is None:
+                self.entries = {}
+            else:
+                self.entries.pop(rse_name, None)
+            self.save()
+
+    def save(self):
+        """Write the cache to disk; must be called with the lock held"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f_out:
+                json.dump(self.entries, f_out, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"could not write discovery cache {self.path} - {e}")
@@ -0,0 +1,187 @@
+import os
+import time
+import yaml
+import logging
+from collections.abc import Mapping
+from threading import Lock
+from types import MappingProxyType
+
+CONFIG = None
+CONFIG_LOCK = Lock()
+
+def freeze(obj):
+    """Return a read-only copy of a parsed YAML object"""
+    if isinstance(obj, dict):
+        return MappingProxyType({key: freeze(val) for key, val in obj.items()})
+    elif isinstance(obj, list):
+        return tuple(freeze(val) for val in obj)
+    else:
+        return obj
+
+class Section(Mapping):
+    """
+    Read-only view of a section of config.yaml; every key in DEFAULTS can be read as an 
+    attribute, which falls back on its default if it is not set, and is converted to the 
+    type of its default if it has one
+
+    Note: a value that cannot be converted is logged and replaced by its default, so that 
+          a bad edit never takes down a running DMM
+    """
+    DEFAULTS = {}
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getattr__(self, key):
+        if key not in self.DEFAULTS:
+            raise AttributeError(f"'{type(self).__name__}' has no key '{key}'")
+        default = self.DEFAULTS[key]
+        value = self.data.get(key)
+        if value is None:
+            return default
+        if isinstance(default, (bool, int, float, str)):
+            try:
+                return type(default)(value)
+            except (TypeError, ValueError):
+                logging.error(f"invalid value for {key} in config.yaml: {value}; using {default}")
+                return default
+        return value
+
+class DMMSection(Section):
+    DEFAULTS = {
+        "host": "localhost",
+        "port": 5000,
+        "authkey": "",
+        "monitoring": False,
+        "coalesce_updates": True,
+        "allocation_policy": "proportional",
+        "batch_window": 0.0,
+        "batch_max_latency": 0.0,
+        "preparer_wait_timeout": 60.0,
+        "discovery_cache": "discovery_cache.json",
+        "discovery_cache_ttl": 86400.0,
+        "history_size": 64,
+        "history_spill_dir": "",
+        "database": "",
+        "persist_interval": 1.0,
+        "job_aging_interval": 30.0,
+        "job_timeout": 0.0,
+        "job_retries": 0,
+        "job_retry_delay": 10.0,
+        "trace_file": "",
+        "profile_dir": "profiles",
+        "profile_interval": 0.01
+    }
+
+class SENSESection(Section):
+    DEFAULTS = {
+        "profile_uuid": None,
+        "pool_clients": True,
+        "async_operations": False,
+        "max_in_flight": 64,
+        "retries": 3,
+        "backoff_base": 0.5,
+        "backoff_max": 30.0,
+        "poll_interval": 1.0,
+        "poll_max_interval": 10.0,
+        "operate_timeout": 600.0,
+        "rate_limit": 0.0,
+        "rate_burst": 1.0,
+        "site_rate_limit": 0.0,
+        "site_rate_burst": 1.0
+    }
+
+class PrometheusSection(Section):
+    DEFAULTS = {
+        "host": None,
+        "port": None,
+        "timeout": 10.0,
+        "dev_map_ttl": 600.0,
+        "dev_map_negative_ttl": 60.0,
+        "dev_map_refresh_interval": 30.0
+    }
+
+class SiteSection(Section):
+    DEFAULTS = {
+        "best_effort_ipv6": None,
+        "ipv6_pool": MappingProxyType({})
+    }
+
+class Config:
+    """
+    Parsed contents of config.yaml, handed out as read-only, typed views of each section; the
+    file is parsed again only when its modification time changes, which is checked at most
+    once every check_interval seconds
+    """
+    def __init__(self, path="config.yaml", check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.mtime = None
+        self.last_checked = 0
+        self.data = MappingProxyType({})
+        # Incremented every time the file is parsed
+        self.version = 0
+        self.reload()
+
+    def reload(self, force=False):
+        """Parse the config file if it has changed since it was last parsed"""
+        with self.lock:
+            self.last_checked = time.time()
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime and not force:
+                return False
+            with open(self.path, "r") as f_in:
+                self.data = freeze(yaml.safe_load(f_in) or {})
+            self.mtime = mtime
+            self.version += 1
+        if self.version > 1:
+            logging.info(f"reloaded {self.path}")
+        return True
+
+    def check(self):
+        """Reload the config file if it is time to check it for changes"""
+        if time.time() - self.last_checked >= self.check_interval:
+            try:
+                self.reload()
+            except (OSError, yaml.YAMLError) as e:
+                logging.error(f"could not reload {self.path}; keeping old config - {e}")
+        return self
+
+    def section(self, name):
+        return self.data.get(name) or MappingProxyType({})
+
+    @property
+    def dmm(self):
+        return DMMSection(self.section("dmm"))
+
+    @property
+    def sense(self):
+        return SENSESection(self.section("sense"))
+
+    @property
+    def prometheus(self):
+        return PrometheusSection(self.section("prometheus"))
+
+    def site(self, rse_name):
+        """Return the config of a given Rucio RSE, or None if there is none"""
+        site_config = self.section("sites").get(rse_name)
+        return None if site_config is None else SiteSection(site_config)
+
+def get_config():
+    """Return the process-wide config, reloading it first if config.yaml has changed"""
+    global CONFIG
+    if CONFIG is None:
+        with CONFIG_LOCK:
+            if CONFIG is None:
+                CONFIG = Config()
+    return CONFIG.check()
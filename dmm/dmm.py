@@ -1,24 +1,132 @@
 import os
-import yaml
+import asyncio
 import logging
 from multiprocessing.connection import Listener
+from multiprocessing.pool import ThreadPool
+from threading import Thread, RLock, Event, Condition
+import dmm.sense_api as sense_api
 from dmm.site import Site
 from dmm.request import Request
 from dmm.orchestrator import Orchestrator
+from dmm.limiter import RateLimiter
+from dmm.allocator import Allocator
+from dmm.batcher import Batcher
+from dmm.cache import DiscoveryCache
+from dmm.config import get_config
+from dmm.stats import HandlerStats
+from dmm.recorder import Recorder
+import dmm.tracing as tracing
+from dmm.prometheus import get_prometheus, Throughputs
 
 class DMM:
-    def __init__(self, n_workers=4):
-        self.orchestrator = Orchestrator(n_workers=n_workers)
+    DAEMONS = ("PREPARER", "SUBMITTER", "FINISHER")
+
+    def __init__(self, n_workers=4, n_handlers=4, n_discovery_workers=8, 
+                 refresh_discovery=False):
+        # SENSE operations are started no faster than the limits in config.yaml allow, 
+        # closures first, then new links by rule priority, then reprovisions; a link job 
+        # that hangs (e.g. on an unresponsive SENSE instance) is abandoned and retried
+        orchestrator_config = get_config().dmm
+        self.orchestrator = Orchestrator(
+            n_workers=n_workers,
+            limiter=RateLimiter(),
+            aging_interval=orchestrator_config.job_aging_interval,
+            job_timeout=orchestrator_config.job_timeout,
+            max_retries=orchestrator_config.job_retries,
+            retry_delay=orchestrator_config.job_retry_delay
+        )
         self.sites = {}
         self.requests = {}
-        with open("config.yaml", "r") as f_in:
-            dmm_config = yaml.safe_load(f_in).get("dmm")
-            self.host = os.environ.get("DMM_HOST", "localhost")
-            self.port = int(os.environ.get("DMM_PORT", 5000))
-            authkey_file = dmm_config.get("authkey", "")
-            self.monitoring = dmm_config.get("monitoring", True)
+        # Serializes every mutation of self.sites, self.requests and their Site counters
+        self.lock = RLock()
+        # Number of preparer messages in flight for each rule; submitter and finisher 
+        # messages for such a rule wait for them to be applied
+        self.preparing = {}
+        self.prepared = Condition(self.lock)
+        # Pool of handler threads shared by all client connections
+        self.n_handlers = n_handlers
+        self.handler_pool = ThreadPool(processes=self.n_handlers)
+        for handler_i, handler in enumerate(self.handler_pool._pool):
+            handler.name = f"HandlerThread-{handler_i:02d}"
+        self.handler_stats = {daemon: HandlerStats() for daemon in DMM.DAEMONS}
+        self.n_connections = 0
+        # Pool of threads that construct (i.e. discover) new Site objects concurrently
+        self.discovery_pool = ThreadPool(processes=n_discovery_workers)
+        for worker_i, worker in enumerate(self.discovery_pool._pool):
+            worker.name = f"DiscoveryThread-{worker_i:02d}"
+        config = get_config()
+        self.config_version = config.version
+        dmm_config = config.dmm
+        self.host = os.environ.get("DMM_HOST", "localhost")
+        self.port = int(os.environ.get("DMM_PORT", 5000))
+        authkey_file = dmm_config.authkey
+        self.coalesce_updates = dmm_config.coalesce_updates
+        self.preparer_wait_timeout = dmm_config.preparer_wait_timeout
+        # Number of history entries kept in memory per request, and where older ones go
+        self.history_size = dmm_config.history_size
+        self.history_spill_dir = dmm_config.history_spill_dir or None
+        if self.history_spill_dir:
+            os.makedirs(self.history_spill_dir, exist_ok=True)
+        self.allocator = Allocator(dmm_config.allocation_policy)
+        # Reallocate once per burst of handler calls rather than once per call
+        self.batcher = Batcher(
+            self.__batched_update,
+            window=dmm_config.batch_window,
+            max_latency=dmm_config.batch_max_latency
+        )
+        self.discovery_cache = DiscoveryCache(
+            path=dmm_config.discovery_cache,
+            ttl=dmm_config.discovery_cache_ttl
+        )
+        if refresh_discovery:
+            self.discovery_cache.invalidate()
         with open(authkey_file, "rb") as f_in:
             self.authkey = f_in.read()
+        # Write the state of every request to a database, if one is configured
+        database_url = dmm_config.database
+        if database_url:
+            from dmm.persister import Persister
+            self.persister = Persister(
+                database_url, 
+                interval=dmm_config.persist_interval
+            )
+        else:
+            self.persister = None
+        # Record every incoming message, if a trace file is configured
+        trace_file = dmm_config.trace_file
+        self.recorder = Recorder(trace_file) if trace_file else None
+        # Set once the saved state has been restored; handlers wait for it
+        self.restored = Event()
+
+    @property
+    def monitoring(self):
+        """Whether to measure actual bandwidths with Prometheus; can be changed at runtime"""
+        return get_config().dmm.monitoring
+
+    @property
+    def async_operations(self):
+        """Whether link jobs use the asyncio SENSE client, running on the orchestrator's 
+        event loop instead of holding a worker thread; can be changed at runtime"""
+        return get_config().sense.async_operations
+
+    def __link_closer(self):
+        return DMM.link_closer_async if self.async_operations else DMM.link_closer
+
+    def __apply_config(self):
+        """Propagate changes to config.yaml to the existing sites"""
+        config = get_config()
+        if config.version != self.config_version:
+            with self.lock:
+                self.config_version = config.version
+                changed_sites = set()
+                for site in self.sites.values():
+                    site.load_config()
+                    # New IPv6 blocks may have been added to the pool
+                    for request in site.admit_waiting_requests():
+                        changed_sites.update((request.src_site.rse_name, request.dst_site.rse_name))
+                        self.__persist(request)
+                if changed_sites:
+                    self.batcher.put("accommodating for waiting requests", changed_sites)
 
     def __dump(self):
         for request in self.requests.values():
@@ -29,61 +137,412 @@ class DMM:
             )
 
     def stop(self):
+        self.batcher.stop()
+        self.handler_pool.close()
+        self.handler_pool.terminate()
+        self.discovery_pool.close()
+        self.discovery_pool.terminate()
         self.orchestrator.stop()
+        if self.persister is not None:
+            self.persister.stop()
+        if self.recorder is not None:
+            self.recorder.close()
         return
 
+    def __persist(self, request):
+        if self.persister is not None:
+            self.persister.put(request)
+
+    def __restore(self):
+        """Rebuild the requests saved by the persister, then check their links with SENSE
+
+        Note: runs on its own thread, so the listener accepts connections in the meantime; 
+              handlers wait until the requests are rebuilt, but not for the SENSE checks, 
+              which are done by the orchestrator
+        """
+        try:
+            records = self.persister.load()
+            logging.info(f"restoring {len(records)} requests")
+            rse_names = set()
+            for record in records:
+                rse_names.update((record["src_rse_name"], record["dst_rse_name"]))
+            new_sites = self.__prefetch_sites(rse_names.difference(self.sites))
+            # Reclaim the IPv6 blocks of every admitted request before any waiting one is 
+            # queued again, since admitting it could hand out one of those blocks
+            records.sort(key=lambda record: record["waiting"])
+            with self.lock:
+                for rse_name, site in new_sites.items():
+                    self.sites.setdefault(rse_name, site)
+                for record in records:
+                    request_id = record["request_id"]
+                    src_site = self.sites.get(record["src_rse_name"])
+                    dst_site = self.sites.get(record["dst_rse_name"])
+                    if src_site is None or dst_site is None:
+                        logging.error(f"cannot restore request {request_id}; site construction failed")
+                        continue
+                    request = Request(
+                        record["rule_id"], 
+                        src_site, 
+                        dst_site, 
+                        transfer_ids=(),
+                        priority=record["priority"],
+                        n_bytes_total=record["n_bytes_total"],
+                        n_transfers_total=record["n_transfers_total"],
+                        history_size=self.history_size,
+                        history_spill_dir=self.history_spill_dir
+                    )
+                    if record["n_transfers_finished"] == record["n_transfers_total"]:
+                        # Finished before the restart; its link may not have been closed yet
+                        if record["link_is_open"] or record["sense_link_id"]:
+                            request.link_is_open = record["link_is_open"]
+                            request.sense_link_id = record["sense_link_id"]
+                            closer_args = (request, False, self.persister)
+                            self.orchestrator.put(
+                                request_id, 
+                                self.__link_closer(), 
+                                closer_args, 
+                                rate_keys=request.get_sense_names(),
+                                job_class="close"
+                            )
+                        else:
+                            self.persister.delete(request_id)
+                        continue
+                    request.restore(record)
+                    self.requests[request_id] = request
+                    if request.sense_link_id and not request.best_effort:
+                        reconciler_args = (request, self.persister)
+                        self.orchestrator.put(
+                            request_id, 
+                            DMM.link_reconciler, 
+                            reconciler_args, 
+                            rate_keys=request.get_sense_names(),
+                            job_class="reprovision",
+                            priority=request.priority
+                        )
+                self.batcher.put("restoring saved state", None)
+        except Exception as e:
+            logging.error(f"could not restore saved state, dumping error\n{e}")
+        finally:
+            self.restored.set()
+
     def start(self):
+        if self.persister is not None:
+            restore_thread = Thread(target=self.__restore, daemon=True)
+            restore_thread.name = "RestoreThread"
+            restore_thread.start()
+        else:
+            self.restored.set()
         listener = Listener((self.host, self.port), authkey=self.authkey)
         while True:
             logging.info("Waiting for the next connection")
-            with listener.accept() as connection:
-                client_host, client_port = listener.last_accepted
-                logging.info(f"Connection accepted from {client_host}:{client_port}")
-                # Process payload from new connection
-                daemon, payload = connection.recv()
-                if daemon.upper() == "PREPARER":
-                    self.preparer_handler(payload)
-                elif daemon.upper() == "SUBMITTER":
-                    result = self.submitter_handler(payload)
+            connection = listener.accept()
+            client_host, client_port = listener.last_accepted
+            logging.info(f"Connection accepted from {client_host}:{client_port}")
+            # Serve each connection on its own thread so that clients never wait on each other
+            connection_thread = Thread(target=self.__serve, args=(connection,), daemon=True)
+            connection_thread.name = f"ConnThread-{self.n_connections:02d}"
+            connection_thread.start()
+            self.n_connections += 1
+
+    def __serve(self, connection):
+        """Process every message sent over a connection until the client hangs up"""
+        with connection:
+            while True:
+                try:
+                    daemon, payload = connection.recv()
+                except EOFError:
+                    break
+                daemon = daemon.upper()
+                if daemon not in self.handler_stats:
+                    logging.error(f"received message from unknown daemon '{daemon}'")
+                    continue
+                if self.recorder is not None:
+                    self.recorder.record(daemon, payload)
+                # Wait for a free handler thread
+                arrival_time = self.handler_stats[daemon].queue()
+                try:
+                    result = self.handler_pool.apply(
+                        self.__handle, 
+                        (daemon, payload, arrival_time)
+                    )
+                except Exception as e:
+                    logging.error(f"{daemon.lower()} handler failed, dumping error\n{e}")
+                    result = None
+                if daemon == "SUBMITTER":
                     connection.send(result)
-                elif daemon.upper() == "FINISHER":
-                    self.finisher_handler(payload)
+
+    def __handle(self, daemon, payload, arrival_time):
+        stats = self.handler_stats[daemon]
+        self.restored.wait()
+        start_time = stats.start(arrival_time)
+        try:
+            handler_span = tracing.span(
+                f"handle {daemon.lower()}", 
+                n_rules=len(payload), 
+                wait=start_time - arrival_time
+            )
+            with handler_span:
+                self.__apply_config()
+                if daemon == "PREPARER":
+                    return self.preparer_handler(payload)
+                elif daemon == "SUBMITTER":
+                    return self.submitter_handler(payload)
+                elif daemon == "FINISHER":
+                    return self.finisher_handler(payload)
+        finally:
+            latency = stats.finish(start_time)
+            logging.debug(f"{daemon.lower()} message handled in {latency:0.3f}s")
+
+    def get_handler_stats(self):
+        """Return the queue depth and handler latencies for each Rucio daemon"""
+        return {daemon: stats.summary() for daemon, stats in self.handler_stats.items()}
+
+    def get_ipv6_occupancy(self):
+        """Return the IPv6 block occupancy and admission queue length at each site"""
+        with self.lock:
+            return {rse_name: site.get_ipv6_occupancy() for rse_name, site in self.sites.items()}
+
+    def get_link_stats(self):
+        """Return the number of open links and their total provisioned bandwidth (in Mb/s) 
+        for each (source RSE, destination RSE) pair"""
+        link_stats = {}
+        with self.lock:
+            for request in self.requests.values():
+                if not request.link_is_open:
+                    continue
+                rse_pair = (request.src_site.rse_name, request.dst_site.rse_name)
+                n_links, bandwidth = link_stats.get(rse_pair, (0, 0))
+                link_stats[rse_pair] = (n_links + 1, bandwidth + request.bandwidth)
+        return link_stats
 
     @staticmethod
-    def link_updater(request, msg, monitoring):
+    def link_updater(request, msg, monitoring, bandwidth=None, throughputs=None, 
+                     persister=None):
+        if not request.src_ipv6:
+            # Deregistered (i.e. finished) after this update was queued
+            return
         # Update link
         old_bandwidth = request.bandwidth
-        if request.link_is_open:
-            request.reprovision_link()
-            changed = (old_bandwidth != request.bandwidth)
-        else:
-            request.open_link()
-            changed = True
+        try:
+            if request.link_is_open:
+                request.reprovision_link(bandwidth=bandwidth)
+                changed = (old_bandwidth != request.bandwidth)
+            else:
+                request.open_link(bandwidth=bandwidth)
+                changed = True
+        finally:
+            # Save the new link ID, even if only part of the update went through, unless 
+            # the link closer has already deleted the request (e.g. while this update hung)
+            if persister is not None and request.src_ipv6:
+                persister.put(request)
+        if not request.src_ipv6:
+            return
         # Update metadata
         if changed and not request.best_effort:
             logging.debug(f"{request} | {old_bandwidth} --> {request.bandwidth}; {msg}")
-        request.update_history(msg, monitoring=monitoring)
+        request.update_history(msg, monitoring=monitoring, throughputs=throughputs)
+
+    @staticmethod
+    async def link_updater_async(request, msg, monitoring, bandwidth=None, throughputs=None, 
+                                 persister=None):
+        """Same as DMM.link_updater, but with the asyncio SENSE client"""
+        if not request.src_ipv6:
+            return
+        old_bandwidth = request.bandwidth
+        try:
+            if request.link_is_open:
+                await request.reprovision_link_async(bandwidth=bandwidth)
+                changed = (old_bandwidth != request.bandwidth)
+            else:
+                await request.open_link_async(bandwidth=bandwidth)
+                changed = True
+        finally:
+            if persister is not None and request.src_ipv6:
+                persister.put(request)
+        if not request.src_ipv6:
+            return
+        if changed and not request.best_effort:
+            logging.debug(f"{request} | {old_bandwidth} --> {request.bandwidth}; {msg}")
+        # Measuring the actual bandwidth may query Prometheus
+        await asyncio.to_thread(
+            request.update_history, msg, monitoring=monitoring, throughputs=throughputs
+        )
 
     @staticmethod
-    def link_closer(request, monitoring):
+    def link_closer(request, monitoring, persister=None):
         logging.debug(f"{request} | closing link")
         request.close_link()
+        if persister is not None:
+            persister.delete(request.request_id)
         request.update_history("closing link", monitoring=monitoring)
         # Log the promised and actual bandwidths
         summary = request.get_summary(string=True, monitoring=monitoring)
         logging.info(f"{request} | {summary}; closed")
 
-    def update_requests(self, msg):
-        """Update bandwidth provisions for all links"""
+    @staticmethod
+    async def link_closer_async(request, monitoring, persister=None):
+        """Same as DMM.link_closer, but with the asyncio SENSE client"""
+        logging.debug(f"{request} | closing link")
+        await request.close_link_async()
+        if persister is not None:
+            persister.delete(request.request_id)
+        await asyncio.to_thread(request.update_history, "closing link", monitoring=monitoring)
+        summary = request.get_summary(string=True, monitoring=monitoring)
+        logging.info(f"{request} | {summary}; closed")
+
+    @staticmethod
+    def link_reconciler(request, persister):
+        """Check a link restored from the database against SENSE; a link that is not ready 
+        is deleted, if it still exists, and opened again in the next reallocation round"""
+        try:
+            status = sense_api.get_link_status(request.sense_link_id)
+        except Exception as e:
+            status = f"unknown ({e})"
+        if request.link_is_open and "READY" in status and "CANCEL" not in status:
+            logging.info(f"{request} | restored link {request.sense_link_id}")
+            return
+        logging.warning(f"{request} | restored link is {status}; reopening it")
+        try:
+            request.close_link()
+        except Exception as e:
+            logging.warning(f"{request} | could not delete restored link - {e}")
+        request.link_is_open = False
+        request.sense_link_id = ""
+        request.theoretical_bandwidth = -1
+        request.bandwidth = 0
+        persister.put(request)
+
+    def update_requests(self, msg, changed_sites=None):
+        """Update bandwidth provisions for all links
+
+        The target bandwidths of all links are computed at once by the allocator, so every 
+        job works from the same snapshot of the priorities. If changed_sites is given, only 
+        links with an endpoint at one of those sites (i.e. whose priority sums may have 
+        changed) are reprovisioned; in either case, open links whose bandwidth provision 
+        would not change are skipped
+        """
         logging.info("updating link bandwidth provisions and metadata")
-        for request_id, request in self.requests.items():
+        if self.allocator.policy != "proportional":
+            # Under max-min fairness, a change at one site can shift every bottleneck
+            changed_sites = None
+        # Requests waiting for an IPv6 block get no link until they are admitted
+        requests = [request for request in self.requests.values() if not request.waiting]
+        targets = self.allocator.allocate(requests).tolist()
+        updates = []
+        n_skipped = 0
+        for request, target in zip(requests, targets):
+            if request.link_is_open:
+                if (
+                    changed_sites is not None
+                    and request.src_site.rse_name not in changed_sites
+                    and request.dst_site.rse_name not in changed_sites
+                ):
+                    n_skipped += 1
+                    continue
+                if target == request.bandwidth:
+                    n_skipped += 1
+                    continue
+            updates.append((request, target))
+        # Measure the throughput of every link updated in this round with a single query, 
+        # covering the interval since the oldest of their last history entries
+        monitoring = self.monitoring
+        if monitoring and updates:
+            start_time = min(request.history.last()[0] for request, _ in updates)
+            links = [
+                (request.get_src_addr(), request.src_site.rse_name) 
+                for request, _ in updates if not request.best_effort
+            ]
+            throughputs = Throughputs(get_prometheus(), start_time, links)
+        else:
+            throughputs = None
+        link_updater = DMM.link_updater_async if self.async_operations else DMM.link_updater
+        for request, target in updates:
             # Submit SENSE query
             link_updater_args = (
                 request,
                 msg if request.link_is_open else "opened link",
-                self.monitoring
+                monitoring,
+                target if target >= 0 else None,
+                throughputs,
+                self.persister
+            )
+            self.orchestrator.put(
+                request.request_id, 
+                link_updater, 
+                link_updater_args, 
+                coalesce=self.coalesce_updates,
+                rate_keys=request.get_sense_names(),
+                job_class="reprovision" if request.link_is_open else "open",
+                priority=request.priority
+            )
+        if n_skipped > 0:
+            logging.debug(f"skipped {n_skipped} links with unchanged bandwidth provisions")
+
+    def __batched_update(self, msgs, changed_sites):
+        with self.lock:
+            with tracing.span("update requests", n_requests=len(self.requests)):
+                self.update_requests("; ".join(msgs), changed_sites)
+
+    def __prefetch_sites(self, rse_names):
+        """Construct the Site objects for the given RSE names concurrently
+
+        Returns a dictionary of the sites that were successfully constructed; failures are 
+        logged and otherwise ignored, so that they only affect the requests at those sites
+        """
+        workers = {
+            rse_name: self.discovery_pool.apply_async(
+                Site, 
+                (rse_name,), 
+                {"discovery_cache": self.discovery_cache}
+            )
+            for rse_name in rse_names
+        }
+        new_sites = {}
+        for rse_name, worker in workers.items():
+            try:
+                new_sites[rse_name] = worker.get()
+            except Exception as e:
+                logging.error(f"could not construct site {rse_name}, dumping error\n{e}")
+        return new_sites
+
+    def __start_preparing(self, payload):
+        """Mark the rules of a preparer message as in flight"""
+        with self.lock:
+            for rule_id in payload:
+                self.preparing[rule_id] = self.preparing.get(rule_id, 0) + 1
+
+    def __finish_preparing(self, payload):
+        """Unmark the rules of a preparer message and wake up the handlers waiting on them"""
+        with self.lock:
+            for rule_id in payload:
+                self.preparing[rule_id] -= 1
+                if self.preparing[rule_id] == 0:
+                    self.preparing.pop(rule_id)
+            self.prepared.notify_all()
+
+    def __wait_for_preparer(self, payload):
+        """Wait until no preparer message for the rules of the payload is in flight, or for 
+        at most preparer_wait_timeout seconds
+
+        Note: must be called with self.lock held, which is released while waiting
+        """
+        is_prepared = lambda: not any(rule_id in self.preparing for rule_id in payload)
+        if not self.prepared.wait_for(is_prepared, timeout=self.preparer_wait_timeout):
+            logging.error(
+                f"gave up waiting for the preparer after {self.preparer_wait_timeout}s"
             )
-            self.orchestrator.put(request_id, DMM.link_updater, link_updater_args)
+
+    def __get_best_effort_ipv6s(self, rse_names):
+        """Return the best effort IPv6 of each of the given RSEs, whether or not its Site 
+        has been constructed"""
+        best_effort_ipv6s = {}
+        for rse_name in rse_names:
+            if rse_name in self.sites:
+                best_effort_ipv6s[rse_name] = self.sites[rse_name].default_ipv6
+            else:
+                site_config = get_config().site(rse_name)
+                best_effort_ipv6s[rse_name] = site_config and site_config.best_effort_ipv6
+        return best_effort_ipv6s
 
     def preparer_handler(self, payload):
         """
@@ -106,29 +565,63 @@ class DMM:
             ...
         }
         """
-        for rule_id, prepared_rule in payload.items():
-            for rse_pair_id, request_attr in prepared_rule.items():
-                src_rse_name, dst_rse_name = rse_pair_id.split("&")
-                # Check if request has already been processed
-                request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
-                if request_id in self.requests.keys():
-                    logging.error("request ID already processed--should never happen!")
+        self.__start_preparing(payload)
+        try:
+            self.__prepare(payload)
+        finally:
+            self.__finish_preparing(payload)
+
+    def __prepare(self, payload):
+        # Construct unseen Site objects before taking the lock; this queries SENSE
+        unseen_rse_names = set()
+        for prepared_rule in payload.values():
+            for rse_pair_id in prepared_rule.keys():
+                unseen_rse_names.update(rse_pair_id.split("&"))
+        new_sites = self.__prefetch_sites(unseen_rse_names.difference(self.sites))
+
+        with self.lock:
+            changed_sites = set()
+            for rse_name, site in new_sites.items():
+                # Another handler may have constructed the same site in the meantime
+                self.sites.setdefault(rse_name, site)
+            for rule_id, prepared_rule in payload.items():
+                # Skip rules with a site that could not be constructed, as a whole
+                rse_names = set()
+                for rse_pair_id in prepared_rule.keys():
+                    rse_names.update(rse_pair_id.split("&"))
+                failed_rse_names = [name for name in rse_names if name not in self.sites]
+                if failed_rse_names:
+                    logging.error(
+                        f"skipping rule {rule_id}; could not construct sites {failed_rse_names}"
+                    )
                     continue
-                # Retrieve or construct source Site object
-                src_site = self.sites.get(src_rse_name, Site(src_rse_name))
-                if src_rse_name not in self.sites.keys():
-                    self.sites[src_rse_name] = src_site
-                # Retrieve or construct destination Site object
-                dst_site = self.sites.get(dst_rse_name, Site(dst_rse_name))
-                if dst_rse_name not in self.sites.keys():
-                    self.sites[dst_rse_name] = dst_site
-                # Create new Request
-                request = Request(rule_id, src_site, dst_site, **request_attr)
-                request.register()
-                # Store new request and its corresponding link
-                self.requests[request_id] = request
-
-        self.update_requests("accommodating for new requests")
+                for rse_pair_id, request_attr in prepared_rule.items():
+                    src_rse_name, dst_rse_name = rse_pair_id.split("&")
+                    # Check if request has already been processed
+                    request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
+                    if request_id in self.requests.keys():
+                        logging.error("request ID already processed--should never happen!")
+                        continue
+                    src_site = self.sites[src_rse_name]
+                    dst_site = self.sites[dst_rse_name]
+                    # Create new Request
+                    request = Request(
+                        rule_id, 
+                        src_site, 
+                        dst_site, 
+                        **request_attr, 
+                        history_size=self.history_size,
+                        history_spill_dir=self.history_spill_dir
+                    )
+                    if request.register():
+                        changed_sites.update((src_rse_name, dst_rse_name))
+                    else:
+                        logging.info(f"{request} | waiting for a free IPv6 block")
+                    self.__persist(request)
+                    # Store new request and its corresponding link
+                    self.requests[request_id] = request
+
+            self.batcher.put("accommodating for new requests", changed_sites)
 
     def submitter_handler(self, payload):
         """
@@ -148,35 +641,50 @@ class DMM:
             ...
         }
         """
-        n_priority_changes = 0
-        sense_map = {}
-        for rule_id, submitter_reports in payload.items():
-            sense_map[rule_id] = {}
-            for rse_pair_id, report in submitter_reports.items():
-                # Get request
-                src_rse_name, dst_rse_name = rse_pair_id.split("&")
-                request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
-                req = self.requests[request_id]
-                # Update request
-                req.n_transfers_submitted += report["n_transfers_submitted"]
-                if report["priority"] != req.priority:
-                    req.priority = report["priority"]
-                    n_priority_changes += 1
-                # Get SENSE link endpoints
-                if req.best_effort:
-                    sense_map[rule_id][rse_pair_id] = {
-                        req.src_site.rse_name: req.src_site.default_ipv6,
-                        req.dst_site.rse_name: req.dst_site.default_ipv6
-                    }
-                else:
-                    sense_map[rule_id][rse_pair_id] = {
-                        # block_to_ipv6 translation is a hack; should not be needed in the future
-                        req.src_site.rse_name: req.src_site.block_to_ipv6[req.src_ipv6],
-                        req.dst_site.rse_name: req.dst_site.block_to_ipv6[req.dst_ipv6]
-                    }
-
-        if n_priority_changes > 0:
-            self.update_requests("adjusting for priority update")
+        with self.lock:
+            self.__wait_for_preparer(payload)
+            changed_sites = set()
+            sense_map = {}
+            for rule_id, submitter_reports in payload.items():
+                sense_map[rule_id] = {}
+                for rse_pair_id, report in submitter_reports.items():
+                    # Get request
+                    src_rse_name, dst_rse_name = rse_pair_id.split("&")
+                    request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
+                    req = self.requests.get(request_id)
+                    if req is None and rule_id in self.preparing:
+                        # Still being prepared; transfer best effort in the meantime
+                        logging.error(f"{request_id} not prepared yet; using best effort")
+                        sense_map[rule_id][rse_pair_id] = self.__get_best_effort_ipv6s(
+                            (src_rse_name, dst_rse_name)
+                        )
+                        continue
+                    elif req is None:
+                        # Skipped by the preparer handler (e.g. a site could not be constructed)
+                        logging.error(f"skipping unknown request {request_id}")
+                        continue
+                    # Update request
+                    req.n_transfers_submitted += report["n_transfers_submitted"]
+                    if report["priority"] != req.priority:
+                        req.update_priority(report["priority"])
+                        changed_sites.update((src_rse_name, dst_rse_name))
+                    self.__persist(req)
+                    # Get SENSE link endpoints
+                    if req.best_effort or req.waiting:
+                        # Waiting requests are transferred best effort until admitted
+                        sense_map[rule_id][rse_pair_id] = {
+                            req.src_site.rse_name: req.src_site.default_ipv6,
+                            req.dst_site.rse_name: req.dst_site.default_ipv6
+                        }
+                    else:
+                        sense_map[rule_id][rse_pair_id] = {
+                            # block_to_ipv6 translation is a hack; should not be needed in the future
+                            req.src_site.rse_name: req.src_site.block_to_ipv6[req.src_ipv6],
+                            req.dst_site.rse_name: req.dst_site.block_to_ipv6[req.dst_ipv6]
+                        }
+
+            if changed_sites:
+                self.batcher.put("adjusting for priority update", changed_sites)
 
         return sense_map
 
@@ -199,25 +707,47 @@ class DMM:
             ...
         }
         """
-        n_link_closures = 0
-        for rule_id, finisher_reports in payload.items():
-            for rse_pair_id, report in finisher_reports.items():
-                # Get request
-                src_rse_name, dst_rse_name = rse_pair_id.split("&")
-                request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
-                request = self.requests[request_id]
-                # Update request
-                request.n_transfers_finished += report["n_transfers_finished"]
-                request.n_bytes_transferred += report["n_bytes_transferred"]
-                if request.n_transfers_finished == request.n_transfers_total:
-                    request.deregister()
-                    # Stage the link for closure
-                    closer_args = (request, self.monitoring)
-                    self.orchestrator.clear(request_id)
-                    self.orchestrator.put(request_id, DMM.link_closer, closer_args)
-                    n_link_closures += 1
-                    # Clean up
-                    self.requests.pop(request_id)
-
-        if n_link_closures > 0:
-            self.update_requests("adjusting for request deletion")
+        with self.lock:
+            self.__wait_for_preparer(payload)
+            changed_sites = set()
+            for rule_id, finisher_reports in payload.items():
+                for rse_pair_id, report in finisher_reports.items():
+                    # Get request
+                    src_rse_name, dst_rse_name = rse_pair_id.split("&")
+                    request_id = Request.id(rule_id, src_rse_name, dst_rse_name)
+                    request = self.requests.get(request_id)
+                    if request is None:
+                        logging.error(f"skipping unknown request {request_id}")
+                        continue
+                    # Update request
+                    request.n_transfers_finished += report["n_transfers_finished"]
+                    request.n_bytes_transferred += report["n_bytes_transferred"]
+                    self.__persist(request)
+                    if request.n_transfers_finished == request.n_transfers_total:
+                        was_waiting = request.waiting
+                        # Freed IPv6 blocks go straight to the requests waiting for them
+                        for admitted in request.deregister():
+                            logging.info(f"{admitted} | admitted")
+                            changed_sites.update(
+                                (admitted.src_site.rse_name, admitted.dst_site.rse_name)
+                            )
+                            self.__persist(admitted)
+                        self.orchestrator.clear(request_id)
+                        if not was_waiting:
+                            changed_sites.update((src_rse_name, dst_rse_name))
+                            # Stage the link for closure
+                            closer_args = (request, self.monitoring, self.persister)
+                            self.orchestrator.put(
+                                request_id, 
+                                self.__link_closer(), 
+                                closer_args, 
+                                rate_keys=request.get_sense_names(),
+                                job_class="close"
+                            )
+                        elif self.persister is not None:
+                            self.persister.delete(request_id)
+                        # Clean up
+                        self.requests.pop(request_id)
+
+            if changed_sites:
+                self.batcher.put("adjusting for request deletion", changed_sites)
@@ -0,0 +1,192 @@
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import dmm.sense_api as sense_api
+import dmm.prometheus as prometheus
+
+def escape(label_value):
+    return str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape(val)}"' for key, val in labels.items())
+    return f"{{{pairs}}}"
+
+def format_bound(upper_bound):
+    return "+Inf" if upper_bound == float("inf") else repr(float(upper_bound))
+
+class MetricsText:
+    """Lines of a scrape in the Prometheus text exposition format"""
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, metric_type, help_text):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+
+    def sample(self, name, value, labels=None):
+        self.lines.append(f"{name}{format_labels(labels)} {value}")
+
+    def histogram(self, name, snapshot, labels=None):
+        """Add the samples of a Histogram snapshot, i.e. (cumulative buckets, sum, count)"""
+        labels = labels or {}
+        buckets, total, count = snapshot
+        for upper_bound, n_observed in buckets:
+            self.sample(f"{name}_bucket", n_observed, {**labels, "le": format_bound(upper_bound)})
+        self.sample(f"{name}_sum", total, labels)
+        self.sample(f"{name}_count", count, labels)
+
+    def __str__(self):
+        return "\n".join(self.lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = self.server.exporter.collect().encode()
+        except Exception as e:
+            logging.error(f"could not collect metrics, dumping error\n{e}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MetricsExporter:
+    """
+    HTTP endpoint that serves the state of DMM's control plane at /metrics in the
+    Prometheus text exposition format; every scrape takes a fresh snapshot
+
+    Note: the DMM lock is only held long enough to count requests and links, so a scrape
+          never waits on SENSE or Prometheus queries
+    """
+    def __init__(self, dmm, host="localhost", port=9464):
+        self.dmm = dmm
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.exporter = self
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.name = "MetricsThread"
+
+    def start(self):
+        host, port = self.server.server_address[:2]
+        logging.info(f"Serving metrics at http://{host}:{port}/metrics")
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def collect(self):
+        """Return the current metrics as the body of a scrape"""
+        text = MetricsText()
+        self.collect_handlers(text)
+        self.collect_orchestrator(text)
+        self.collect_sense(text)
+        self.collect_prometheus(text)
+        self.collect_sites(text)
+        self.collect_links(text)
+        return str(text)
+
+    def collect_handlers(self, text):
+        handler_stats = self.dmm.handler_stats
+        text.header("dmm_handler_messages_queued", "gauge", "Rucio daemon messages waiting for a handler")
+        for daemon, stats in handler_stats.items():
+            text.sample("dmm_handler_messages_queued", stats.n_queued, {"daemon": daemon})
+        text.header("dmm_handler_messages_active", "gauge", "Rucio daemon messages being handled")
+        for daemon, stats in handler_stats.items():
+            text.sample("dmm_handler_messages_active", stats.n_active, {"daemon": daemon})
+        text.header("dmm_handler_wait_seconds", "histogram", "Time messages waited for a handler")
+        for daemon, stats in handler_stats.items():
+            text.histogram("dmm_handler_wait_seconds", stats.wait.snapshot(), {"daemon": daemon})
+        text.header("dmm_handler_latency_seconds", "histogram", "Time spent handling messages")
+        for daemon, stats in handler_stats.items():
+            text.histogram("dmm_handler_latency_seconds", stats.latency.snapshot(), {"daemon": daemon})
+
+    def collect_orchestrator(self, text):
+        stats = self.dmm.orchestrator.get_stats()
+        text.header("dmm_orchestrator_queued_jobs", "gauge", "Link jobs waiting to be submitted")
+        text.sample("dmm_orchestrator_queued_jobs", stats["queued"])
+        text.header("dmm_orchestrator_active_jobs", "gauge", "Link jobs submitted to the workers")
+        text.sample("dmm_orchestrator_active_jobs", stats["active"])
+        text.header("dmm_orchestrator_coalesced_jobs_total", "counter", "Queued link updates replaced by newer ones")
+        text.sample("dmm_orchestrator_coalesced_jobs_total", stats["coalesced"])
+        text.header("dmm_orchestrator_failed_jobs_total", "counter", "Link jobs that raised an error or ran out of retries")
+        text.sample("dmm_orchestrator_failed_jobs_total", stats["failed"])
+        text.header("dmm_orchestrator_timed_out_jobs_total", "counter", "Link jobs abandoned after their timeout")
+        text.sample("dmm_orchestrator_timed_out_jobs_total", stats["timed_out"])
+        text.header("dmm_orchestrator_retried_jobs_total", "counter", "Abandoned link jobs queued again")
+        text.sample("dmm_orchestrator_retried_jobs_total", stats["retried"])
+        text.header("dmm_orchestrator_hung_workers", "gauge", "Worker threads still running an abandoned link job")
+        text.sample("dmm_orchestrator_hung_workers", stats["hung"])
+        text.header("dmm_orchestrator_job_wait_seconds", "histogram", "Time link jobs waited for a worker")
+        text.histogram("dmm_orchestrator_job_wait_seconds", stats["wait_times"])
+        text.header("dmm_orchestrator_class_queued_jobs", "gauge", "Link jobs waiting to be submitted by class")
+        for job_class, n_queued in stats["queued_classes"].items():
+            text.sample("dmm_orchestrator_class_queued_jobs", n_queued, {"class": job_class})
+        text.header("dmm_orchestrator_class_wait_seconds", "histogram", "Time link jobs waited for a worker by class")
+        for job_class, wait_times in stats["class_wait_times"].items():
+            text.histogram("dmm_orchestrator_class_wait_seconds", wait_times, {"class": job_class})
+        text.header("dmm_orchestrator_job_run_seconds", "histogram", "Time link jobs ran on a worker")
+        text.histogram("dmm_orchestrator_job_run_seconds", stats["run_times"])
+        text.header("dmm_orchestrator_throttled_jobs", "gauge", "Link jobs held back by the SENSE rate limiter")
+        text.sample("dmm_orchestrator_throttled_jobs", stats["throttled"])
+        text.header("dmm_orchestrator_rate_limit_wait_seconds", "histogram", "Time link jobs were held back by the SENSE rate limiter")
+        text.histogram("dmm_orchestrator_rate_limit_wait_seconds", stats["limiter_wait_times"])
+        text.header("dmm_rate_limit_throttled_total", "counter", "Link jobs held back by each rate limiter bucket")
+        for bucket, n_throttled in stats["limiter_throttled"].items():
+            text.sample("dmm_rate_limit_throttled_total", n_throttled, {"bucket": bucket})
+        text.header("dmm_rate_limit_tokens", "gauge", "Tokens left in each rate limiter bucket")
+        for bucket, tokens in stats["limiter_tokens"].items():
+            text.sample("dmm_rate_limit_tokens", tokens, {"bucket": bucket})
+
+    def collect_sense(self, text):
+        call_stats = sense_api.get_call_stats()
+        text.header("dmm_sense_call_seconds", "histogram", "Latency of SENSE API calls")
+        for operation, stats in call_stats.items():
+            text.histogram("dmm_sense_call_seconds", stats["latency"], {"operation": operation})
+        text.header("dmm_sense_call_errors_total", "counter", "SENSE API calls that raised an error")
+        for operation, stats in call_stats.items():
+            text.sample("dmm_sense_call_errors_total", stats["errors"], {"operation": operation})
+
+    def collect_prometheus(self, text):
+        # Only report on the Prometheus client if DMM has created it
+        if prometheus.PROMETHEUS is None:
+            return
+        stats = prometheus.PROMETHEUS.get_dev_map_stats()
+        text.header("dmm_dev_map_size", "gauge", "IPv6 addresses in the IPv6 --> device map")
+        text.sample("dmm_dev_map_size", stats["size"])
+        text.header("dmm_dev_map_lookups_total", "counter", "IPv6 --> device map lookups by outcome")
+        for outcome in ["hits", "misses", "negative_hits"]:
+            text.sample("dmm_dev_map_lookups_total", stats[outcome], {"outcome": outcome})
+        text.header("dmm_dev_map_refreshes_total", "counter", "Refreshes of the IPv6 --> device map")
+        text.sample("dmm_dev_map_refreshes_total", stats["refreshes"])
+
+    def collect_sites(self, text):
+        occupancy = self.dmm.get_ipv6_occupancy()
+        text.header("dmm_site_ipv6_blocks", "gauge", "IPv6 blocks at each site by state")
+        for rse_name, site_occupancy in occupancy.items():
+            for state in ["used", "free"]:
+                text.sample("dmm_site_ipv6_blocks", site_occupancy[state], {"site": rse_name, "state": state})
+        text.header("dmm_site_waiting_requests", "gauge", "Requests waiting for a free IPv6 block at each site")
+        for rse_name, site_occupancy in occupancy.items():
+            text.sample("dmm_site_waiting_requests", site_occupancy["waiting"], {"site": rse_name})
+
+    def collect_links(self, text):
+        link_stats = self.dmm.get_link_stats()
+        text.header("dmm_requests", "gauge", "Requests tracked by DMM")
+        text.sample("dmm_requests", len(self.dmm.requests))
+        text.header("dmm_open_links", "gauge", "Open links between each pair of sites")
+        for (src_rse_name, dst_rse_name), (n_links, _) in link_stats.items():
+            text.sample("dmm_open_links", n_links, {"src_site": src_rse_name, "dst_site": dst_rse_name})
+        text.header("dmm_provisioned_bandwidth_mbps", "gauge", "Bandwidth provisioned between each pair of sites (Mb/s)")
+        for (src_rse_name, dst_rse_name), (_, bandwidth) in link_stats.items():
+            text.sample("dmm_provisioned_bandwidth_mbps", bandwidth, {"src_site": src_rse_name, "dst_site": dst_rse_name})
@@ -0,0 +1,91 @@
+import json
+import logging
+from array import array
+
+class History:
+    """
+    Promised and actual bandwidth history of a request, kept as a ring buffer of the most
+    recent entries together with running time-weighted accumulators over every entry
+
+    Each entry is (time, promised bandwidth, actual bandwidth, message); the promised
+    bandwidth of an entry holds until the next entry, while its actual bandwidth is the
+    one measured since the previous entry. Entries that fall out of the buffer are
+    appended to spill_path as JSON lines if one is given, and dropped otherwise.
+    """
+    __slots__ = (
+        "size", "spill_path", "times", "promised_bw", "actual_bw", "msgs", "n_entries", 
+        "first_time", "promised_integral", "actual_integral", "actual_time"
+    )
+
+    def __init__(self, size=64, spill_path=None):
+        self.size = size
+        self.spill_path = spill_path
+        # Columns grow with the first `size` entries, then wrap around
+        self.times = array("d")
+        self.promised_bw = array("d")
+        self.actual_bw = array("d")
+        self.msgs = []
+        # Total number of entries ever appended
+        self.n_entries = 0
+        self.first_time = None
+        # Integrals of the promised bandwidth over all entries, and of the actual bandwidth
+        # over the measured entries since the link was provisioned (i.e. entries 2, 3, ...)
+        self.promised_integral = 0
+        self.actual_integral = 0
+        self.actual_time = 0
+
+    def __len__(self):
+        return min(self.n_entries, self.size)
+
+    def __iter__(self):
+        """Iterate over the entries still in the buffer, oldest first"""
+        for entry_i in range(self.n_entries - len(self), self.n_entries):
+            yield self[entry_i % self.size]
+
+    def __getitem__(self, slot):
+        return (self.times[slot], self.promised_bw[slot], self.actual_bw[slot], self.msgs[slot])
+
+    def last(self):
+        """Return the most recent entry"""
+        return self[(self.n_entries - 1) % self.size]
+
+    def append(self, time, promised_bw, actual_bw, msg):
+        if self.n_entries == 0:
+            self.first_time = time
+        else:
+            time_last, promised_last, _, _ = self.last()
+            dt = time - time_last
+            self.promised_integral += promised_last*dt
+            if self.n_entries >= 2 and actual_bw >= 0:
+                self.actual_integral += actual_bw*dt
+                self.actual_time += dt
+        if self.n_entries < self.size:
+            self.times.append(time)
+            self.promised_bw.append(promised_bw)
+            self.actual_bw.append(actual_bw)
+            self.msgs.append(msg)
+        else:
+            slot = self.n_entries % self.size
+            if self.spill_path:
+                self.spill(self[slot])
+            self.times[slot] = time
+            self.promised_bw[slot] = promised_bw
+            self.actual_bw[slot] = actual_bw
+            self.msgs[slot] = msg
+        self.n_entries += 1
+
+    def spill(self, entry):
+        try:
+            with open(self.spill_path, "a") as f_out:
+                f_out.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            logging.warning(f"could not spill history to {self.spill_path} - {e}")
+
+    def summary(self):
+        """Return the time-weighted average promised and actual bandwidth (-1 if the actual
+        bandwidth was never measured)"""
+        elapsed = self.last()[0] - self.first_time if self.n_entries > 0 else 0
+        avg_promise = self.promised_integral/elapsed if elapsed > 0 else 0
+        avg_actual = self.actual_integral/self.actual_time if self.actual_time > 0 else -1
+        return avg_promise, avg_actual
+
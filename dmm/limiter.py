@@ -0,0 +1,112 @@
+from dmm.config import get_config
+
+class TokenBucket:
+    """Bucket that fills up with `rate` tokens per second, up to `burst` tokens"""
+    __slots__ = ("rate", "burst", "tokens", "last_time")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time)*self.rate)
+        self.last_time = now
+
+    def wait_time(self):
+        """Return the seconds until the bucket holds a whole token"""
+        return 0 if self.tokens >= 1 else (1 - self.tokens)/self.rate
+
+class RateLimiter:
+    """
+    Token buckets that bound how fast SENSE operations are started: one bucket shared by
+    every operation, and one per SENSE URI (i.e. Site.sense_name) for operations on links
+    to or from that site; an operation only starts once every bucket it draws from has a
+    token, so a burst of updates is spread out instead of hitting SENSE all at once
+
+    The rates and burst sizes are read from the sense section of config.yaml; a rate of 0
+    disables the corresponding buckets.
+
+    Note: not thread-safe; only meant to be used by the orchestrator, under its lock
+    """
+    def __init__(self):
+        self.config_version = None
+        self.rate = 0
+        self.burst = 1
+        self.site_rate = 0
+        self.site_burst = 1
+        self.global_bucket = None
+        self.site_buckets = {}
+
+    def load_config(self, now):
+        """Apply the current limits, keeping the tokens already in the buckets"""
+        config = get_config()
+        if config.version == self.config_version:
+            return
+        self.config_version = config.version
+        sense_config = config.sense
+        self.rate = sense_config.rate_limit
+        self.burst = max(sense_config.rate_burst, 1)
+        self.site_rate = sense_config.site_rate_limit
+        self.site_burst = max(sense_config.site_rate_burst, 1)
+        if self.rate > 0:
+            if self.global_bucket is None:
+                self.global_bucket = TokenBucket(self.rate, self.burst, now)
+            self.reconfigure(self.global_bucket, self.rate, self.burst, now)
+        else:
+            self.global_bucket = None
+        if self.site_rate > 0:
+            for bucket in self.site_buckets.values():
+                self.reconfigure(bucket, self.site_rate, self.site_burst, now)
+        else:
+            self.site_buckets = {}
+
+    @staticmethod
+    def reconfigure(bucket, rate, burst, now):
+        bucket.refill(now)
+        bucket.rate = rate
+        bucket.burst = burst
+        bucket.tokens = min(bucket.tokens, burst)
+
+    def __get_buckets(self, sense_names, now):
+        buckets = []
+        if self.global_bucket is not None:
+            buckets.append(("global", self.global_bucket))
+        if self.site_rate > 0:
+            for sense_name in sense_names:
+                bucket = self.site_buckets.get(sense_name)
+                if bucket is None:
+                    bucket = TokenBucket(self.site_rate, self.site_burst, now)
+                    self.site_buckets[sense_name] = bucket
+                buckets.append((sense_name, bucket))
+        return buckets
+
+    def acquire(self, sense_names, now):
+        """Take a token from the global bucket and from the bucket of each given SENSE URI
+        if they all have one; otherwise, take nothing
+
+        Returns the seconds until every bucket will have a token (0 if the tokens were
+        taken) and the buckets ("global" or a SENSE URI) that are out of tokens
+        """
+        self.load_config(now)
+        buckets = self.__get_buckets(set(sense_names), now)
+        wait_time = 0
+        empty_buckets = []
+        for key, bucket in buckets:
+            bucket.refill(now)
+            bucket_wait_time = bucket.wait_time()
+            if bucket_wait_time > 0:
+                empty_buckets.append(key)
+                wait_time = max(wait_time, bucket_wait_time)
+        if wait_time == 0:
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+        return wait_time, empty_buckets
+
+    def get_tokens(self):
+        """Return the number of tokens left in each bucket, as of its last refill"""
+        tokens = {sense_name: bucket.tokens for sense_name, bucket in self.site_buckets.items()}
+        if self.global_bucket is not None:
+            tokens["global"] = self.global_bucket.tokens
+        return tokens
@@ -1,88 +1,451 @@
+import asyncio
 import logging
 import time
 import json
 from multiprocessing.pool import ThreadPool
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition
+from dmm.stats import Histogram
+import dmm.tracing as tracing
+
+# Order in which queued jobs of each class are started: closures free IPv6 blocks and 
+# bandwidth for the rest, so they go first; jobs of any other class go last
+JOB_CLASSES = ["close", "open", "reprovision"]
+
+class Job:
+    __slots__ = ("worker_func", "args", "coalesce", "queued_time", "rate_keys", "job_class", 
+                 "priority", "rank", "timeout", "n_attempts", "not_before", "deadline", 
+                 "handle")
+
+    def __init__(self, worker_func, args, coalesce, queued_time, rate_keys, job_class, 
+                 priority, timeout):
+        self.worker_func = worker_func
+        self.args = args
+        self.coalesce = coalesce
+        self.queued_time = queued_time
+        self.rate_keys = rate_keys
+        self.job_class = job_class
+        self.priority = priority
+        if job_class in JOB_CLASSES:
+            self.rank = JOB_CLASSES.index(job_class)
+        else:
+            self.rank = len(JOB_CLASSES)
+        self.timeout = timeout
+        self.n_attempts = 0
+        # Time before which the job may not start (i.e. the end of its retry backoff)
+        self.not_before = 0
+        # Time by which the job must have finished once started, if any, and the 
+        # AsyncResult (worker thread) or Future (event loop) of the running job
+        self.deadline = None
+        self.handle = None
+
+    @property
+    def is_coroutine(self):
+        return asyncio.iscoroutinefunction(self.worker_func)
 
 class Orchestrator:
-    def __init__(self, n_workers=4, logging_interval=10):
+    """
+    Runs queued jobs on a pool of worker threads (or on an event loop, for coroutines), 
+    one job per job name at a time
+
+    A job that runs past its timeout is abandoned, so that its job name can start its next 
+    job. An abandoned coroutine is cancelled, then queued again, after a backoff of 
+    retry_delay*2^(attempt - 1) seconds, until it has been tried max_retries + 1 times. An 
+    abandoned worker thread cannot be stopped, so a new worker thread is started in its 
+    place until it returns, and the job is never retried.
+
+    Note: an abandoned worker thread job may still be running when the next job of its name 
+          starts, so both may act on the same link; a retry would only add to this
+    """
+    def __init__(self, n_workers=4, logging_interval=10, limiter=None, aging_interval=30, 
+                 job_timeout=0, max_retries=0, retry_delay=10):
         self.n_workers = n_workers
         self.pool = ThreadPool(processes=self.n_workers)
-        # Rename worker threads
-        for worker_i, worker in enumerate(self.pool._pool):
-            worker.name = f"WorkThread-{worker_i:02d}"
+        self.__name_workers()
         self.queued = {}
         self.active = {}
+        # Number of active jobs that hold a worker thread
+        self.n_busy = 0
+        # Number of worker threads still running a job that was abandoned
+        self.n_hung = 0
+        # Default seconds a job may run before it is abandoned (0 for no limit), and the 
+        # retry policy of abandoned jobs
+        self.job_timeout = job_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.n_timed_out = 0
+        self.n_retried = 0
+        # Seconds a queued job waits before it is moved ahead of the next class of jobs
+        self.aging_interval = aging_interval
+        self.finished = []
+        # Event loop that runs the jobs that are coroutines, which wait on I/O without 
+        # holding a worker thread
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.name = "LoopThread"
+        self.loop_thread.start()
         self.thread = Thread(target=self.__start)
         self.thread.name = "OrchThread"
         self.lock = Lock()
+        # Signalled whenever a job is queued or finishes
+        self.condition = Condition(self.lock)
+        self.pending = False
         self.__stop_event = Event()
         self.last_logged = 0
         self.logging_interval = logging_interval
+        # Number of queued jobs that were replaced by a newer job before they ran; for 
+        # DMM link updaters, each one is a SENSE reprovisioning round trip that was saved
+        self.n_coalesced = 0
+        self.n_failed = 0
+        # Time each job spent queued before a worker picked it up, and running on a worker
+        self.wait_times = Histogram()
+        self.run_times = Histogram()
+        self.class_wait_times = {job_class: Histogram() for job_class in JOB_CLASSES + ["other"]}
+        # Rate limiter of jobs queued with rate_keys, and the time at which each job name 
+        # that is being held back by it was first held back
+        self.limiter = limiter
+        self.throttled = {}
+        # Earliest time at which a held back job can start or an active job times out
+        self.next_wake_time = None
+        self.limiter_exhausted = False
+        self.limiter_wait_times = Histogram()
+        # Number of jobs held back by each bucket of the rate limiter
+        self.n_throttled = {}
         self.thread.start()
 
     def __start(self):
         logging.debug(f"Orchestrator started with {self.n_workers} workers")
-        while not self.__stop_event.is_set():
-            finished_jobs = []
-            # Check for job completion
-            for job_name, worker in self.active.items():
-                if worker.ready():
-                    finished_jobs.append(job_name)
-                    if worker.successful():
+        with self.condition:
+            while not self.__stop_event.is_set():
+                self.pending = False
+                # Retire finished jobs
+                while len(self.finished) > 0:
+                    job_name, job, attempt, error = self.finished.pop()
+                    if self.active.get(job_name) is not job or job.n_attempts != attempt:
+                        # Abandoned (timed out or cancelled); its retry, if any, is already queued
+                        if not job.is_coroutine:
+                            self.n_hung -= 1
+                        logging.warning(f"{job_name} finished after it was abandoned")
+                        continue
+                    self.active.pop(job_name)
+                    if not job.is_coroutine:
+                        self.n_busy -= 1
+                    if error is None:
                         logging.debug(f"{job_name} finished")
                     else:
-                        try:
-                            worker.get()
-                        except Exception as e:
-                            logging.error(f"{job_name} failed, dumping error\n{e}")
-            while len(finished_jobs) > 0:
-                self.active.pop(finished_jobs.pop())
-            # Submit jobs that do not have the same job name as any active job
-            self.lock.acquire()
-            for job_name, job_queue in self.queued.items():
-                if job_name not in self.active.keys():
-                    worker_func, job_args = job_queue.pop()
-                    self.active[job_name] = self.pool.apply_async(worker_func, job_args)
+                        self.n_failed += 1
+                        logging.error(f"{job_name} failed, dumping error\n{error}")
+                # Abandon jobs that are past their deadline
+                now = time.time()
+                self.next_wake_time = None
+                overdue_jobs = [
+                    (job_name, job) for job_name, job in self.active.items()
+                    if job.deadline is not None and job.deadline <= now
+                ]
+                for job_name, job in overdue_jobs:
+                    self.n_timed_out += 1
+                    self.__abandon(job_name, job, f"timed out after {job.timeout}s")
+                    self.__retry(job_name, job, now)
+                # Submit jobs that do not have the same job name as any active job, in order 
+                # of precedence, as long as there are workers free to run them
+                emptied_queues = []
+                self.limiter_exhausted = False
+                for job_name in self.__schedule(now):
+                    job_queue = self.queued[job_name]
+                    job = job_queue[-1]
+                    if not job.is_coroutine and self.n_busy >= self.n_workers:
+                        continue
+                    if not self.__admit(job_name, job.rate_keys, now):
+                        continue
+                    job_queue.pop()
+                    job.n_attempts += 1
+                    if job.timeout:
+                        job.deadline = now + job.timeout
+                    if job.is_coroutine:
+                        job.handle = asyncio.run_coroutine_threadsafe(
+                            self.__arun(job_name, job, job.n_attempts),
+                            self.loop
+                        )
+                    else:
+                        job.handle = self.pool.apply_async(
+                            self.__run,
+                            (job,),
+                            callback=self.__on_finish(job_name, job, job.n_attempts),
+                            error_callback=self.__on_finish(
+                                job_name, job, job.n_attempts, failed=True
+                            )
+                        )
+                        self.n_busy += 1
+                    self.active[job_name] = job
                     logging.debug(f"{job_name} submitted")
                     if len(job_queue) == 0:
-                        finished_jobs.append(job_name)
-            while len(finished_jobs) > 0:
-                self.queued.pop(finished_jobs.pop())
-            # Logging
-            now = time.time()
-            if (now - self.last_logged) >= self.logging_interval:
-                if self.active:
-                    logging.debug(f"Active jobs: {', '.join(self.active)}")
-                else:
-                    logging.debug(f"No active orchestrator jobs")
-                if self.queued:
-                    queue_lengths = [f"{n}: {len(q)}" for n, q in self.queued.items()]
-                    logging.debug(f"Queued jobs: {', '.join(queue_lengths)}")
-                else:
-                    logging.debug(f"No queued orchestrator jobs")
-                self.last_logged = now
-            self.lock.release()
+                        emptied_queues.append(job_name)
+                while len(emptied_queues) > 0:
+                    self.queued.pop(emptied_queues.pop())
+                # Logging
+                now = time.time()
+                if (now - self.last_logged) >= self.logging_interval:
+                    if self.active:
+                        logging.debug(f"Active jobs: {', '.join(self.active)}")
+                    else:
+                        logging.debug(f"No active orchestrator jobs")
+                    if self.queued:
+                        queue_lengths = [f"{n}: {len(q)}" for n, q in self.queued.items()]
+                        logging.debug(f"Queued jobs: {', '.join(queue_lengths)}")
+                    else:
+                        logging.debug(f"No queued orchestrator jobs")
+                    if self.n_coalesced > 0:
+                        logging.debug(f"Coalesced jobs: {self.n_coalesced}")
+                    if self.n_hung > 0:
+                        logging.warning(f"Worker threads hung on abandoned jobs: {self.n_hung}")
+                    self.last_logged = now
+                # Sleep until a job is queued or finishes, waking up for the periodic logging, 
+                # when a held back job can start or when an active job is due
+                for job in self.active.values():
+                    if job.deadline is not None:
+                        self.__wake_at(job.deadline)
+                wake_time = self.last_logged + self.logging_interval
+                if self.next_wake_time is not None:
+                    wake_time = min(wake_time, self.next_wake_time)
+                self.condition.wait_for(
+                    lambda: self.pending or self.__stop_event.is_set(),
+                    timeout=max(wake_time - time.time(), 0)
+                )
+
+    def __schedule(self, now):
+        """Return the names of the queued jobs that can start, in the order they should start
+
+        Jobs go by class (see JOB_CLASSES), then by descending priority, then by the time 
+        they were queued; a job is moved one class ahead for every aging_interval seconds it 
+        has waited, so that no class is starved. A job also goes ahead of its own class if a 
+        job of a better class is queued behind it under the same name (e.g. a closure queued 
+        behind a reprovision), since that job cannot start until this one has run.
+        """
+        ranked_names = []
+        for job_name, job_queue in self.queued.items():
+            if job_name in self.active:
+                continue
+            job = job_queue[-1]
+            if job.not_before > now:
+                self.__wake_at(job.not_before)
+                continue
+            rank = min(queued_job.rank for queued_job in job_queue)
+            if self.aging_interval > 0:
+                rank -= int((now - job.queued_time)//self.aging_interval)
+            ranked_names.append(((rank, -job.priority, job.queued_time), job_name))
+        ranked_names.sort(key=lambda ranked_name: ranked_name[0])
+        return [job_name for _, job_name in ranked_names]
+
+    def __admit(self, job_name, rate_keys, now):
+        """Return whether the rate limiter lets the next job of the given name start now"""
+        if self.limiter is None or rate_keys is None:
+            return True
+        if self.limiter_exhausted:
+            # The global bucket ran out earlier in this pass; no need to ask again
+            empty_buckets = ["global"]
+        else:
+            wait_time, empty_buckets = self.limiter.acquire(rate_keys, now)
+            if wait_time > 0:
+                self.__wake_at(now + wait_time)
+                self.limiter_exhausted = "global" in empty_buckets
+        if empty_buckets:
+            if job_name not in self.throttled:
+                self.throttled[job_name] = now
+                for bucket in empty_buckets:
+                    self.n_throttled[bucket] = self.n_throttled.get(bucket, 0) + 1
+            return False
+        self.limiter_wait_times.observe(now - self.throttled.pop(job_name, now))
+        return True
+
+    def __wake_at(self, wake_time):
+        if self.next_wake_time is None or wake_time < self.next_wake_time:
+            self.next_wake_time = wake_time
+
+    def __name_workers(self):
+        """Name the worker threads that the pool has started since it was last called"""
+        for worker_i, worker in enumerate(self.pool._pool):
+            if not worker.name.startswith("WorkThread"):
+                worker.name = f"WorkThread-{worker_i:02d}"
+
+    def __abandon(self, job_name, job, reason):
+        """Stop waiting on an active job, so that the next job of the same name can start"""
+        self.active.pop(job_name)
+        if job.is_coroutine:
+            # Raises CancelledError in the coroutine, wherever it is awaiting
+            job.handle.cancel()
+            logging.error(f"{job_name} {reason}; cancelled it")
+            return
+        # The worker thread stays stuck in the job, so start another one to take its place
+        self.n_busy -= 1
+        self.n_hung += 1
+        if len(self.pool._pool) < self.n_workers + self.n_hung:
+            self.pool._processes += 1
+            self.pool._repopulate_pool()
+            self.__name_workers()
+        logging.error(
+            f"{job_name} {reason}; abandoned it to its worker thread ({self.n_hung} hung)"
+        )
+
+    def __retry(self, job_name, job, now):
+        """Queue an abandoned coroutine job again as the next job of its name, if it has tries 
+        left"""
+        if not job.is_coroutine:
+            # Still running in its worker thread, which would race with the retry
+            self.n_failed += 1
+            logging.error(f"{job_name} is not retried; it may still be running")
+            return
+        if job.n_attempts > self.max_retries:
+            self.n_failed += 1
+            logging.error(f"{job_name} gave up after {job.n_attempts} attempts")
+            return
+        job_queue = self.queued.setdefault(job_name, [])
+        if job.coalesce and job_queue and job_queue[-1].coalesce:
+            # Superseded by a newer job that was queued while this one ran
+            self.n_coalesced += 1
+            return
+        job.not_before = now + self.retry_delay*2**(job.n_attempts - 1)
+        job.queued_time = job.not_before
+        job.deadline = None
+        job.handle = None
+        job_queue.append(job)
+        self.n_retried += 1
+        logging.warning(f"{job_name} will be retried in {job.not_before - now:0.1f}s")
+
+    def __observe_wait(self, job, start_time):
+        wait_time = start_time - job.queued_time
+        self.wait_times.observe(wait_time)
+        self.class_wait_times.get(job.job_class, self.class_wait_times["other"]).observe(wait_time)
+        return wait_time
+
+    def __run(self, job):
+        """Run a job on a worker thread, timing how long it waited and ran"""
+        start_time = time.time()
+        wait_time = self.__observe_wait(job, start_time)
+        try:
+            with tracing.span(job.worker_func.__name__, wait=wait_time, job_class=job.job_class):
+                return job.worker_func(*job.args)
+        finally:
+            self.run_times.observe(time.time() - start_time)
+
+    async def __arun(self, job_name, job, attempt):
+        """Run a coroutine job on the event loop, timing how long it waited and ran"""
+        start_time = time.time()
+        self.__observe_wait(job, start_time)
+        try:
+            result = await job.worker_func(*job.args)
+        except Exception as e:
+            self.__on_finish(job_name, job, attempt, failed=True)(e)
+        else:
+            self.__on_finish(job_name, job, attempt)(result)
+        finally:
+            self.run_times.observe(time.time() - start_time)
+
+    def __on_finish(self, job_name, job, attempt, failed=False):
+        """Return a worker callback that hands a finished attempt at a job back to the 
+        orchestrator"""
+        def callback(result):
+            with self.condition:
+                self.finished.append((job_name, job, attempt, result if failed else None))
+                self.pending = True
+                self.condition.notify()
+        return callback
 
     def stop(self):
+        with self.condition:
+            self.__stop_event.set()
+            self.condition.notify()
+        self.thread.join()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
         self.pool.close()
         self.pool.terminate()
         self.clear()
-        self.__stop_event.set()
-        self.thread.join()
 
     def clear(self, job_name=""):
-        self.lock.acquire()
-        if not job_name:
-            self.queued = {}
-        elif job_name in self.queued.keys():
-            self.queued[job_name] = []
-        self.lock.release()
-
-    def put(self, job_name, worker_func, job_args):
-        self.lock.acquire()
-        if job_name in self.queued.keys():
-            self.queued[job_name].insert(0, (worker_func, job_args))
-        else:
-            self.queued[job_name] = [(worker_func, job_args)]
-        self.lock.release()
+        with self.condition:
+            if not job_name:
+                self.queued = {}
+                self.throttled = {}
+            else:
+                self.queued.pop(job_name, None)
+                self.throttled.pop(job_name, None)
+
+    def cancel(self, job_name):
+        """Drop the queued jobs of the given name and abandon its active job, if any, 
+        without retrying it"""
+        with self.condition:
+            self.queued.pop(job_name, None)
+            self.throttled.pop(job_name, None)
+            job = self.active.get(job_name)
+            if job is not None:
+                self.__abandon(job_name, job, "was cancelled")
+                self.pending = True
+                self.condition.notify()
+
+    def put(self, job_name, worker_func, job_args, coalesce=False, rate_keys=None, 
+            job_class=None, priority=0, timeout=None):
+        """Queue a job; jobs with the same name run one at a time in the order queued
+
+        If coalesce is True, the new job replaces the most recently queued job of the same 
+        name, as long as that job was also queued with coalesce=True; i.e. only the latest 
+        of a run of coalescable jobs is ever run, while other jobs are never dropped
+
+        If worker_func is a coroutine function, the job is run on the event loop instead of 
+        a worker thread, so any number of such jobs can wait on I/O at the same time
+
+        If rate_keys is given (e.g. the SENSE URIs of both ends of a link), the job only 
+        starts once the rate limiter, if any, has a token for it globally and for each key
+
+        Jobs of different names start in order of job_class (one of JOB_CLASSES, if any), 
+        then priority (highest first); see Orchestrator.__schedule
+
+        The job is abandoned, then retried if it is a coroutine, if it runs for longer than 
+        timeout seconds (by default, the job_timeout of the orchestrator; 0 for no limit)
+        """
+        tracing.instant("enqueue", job=job_name, func=worker_func.__name__)
+        with self.condition:
+            job_queue = self.queued.get(job_name, [])
+            job = Job(
+                worker_func, job_args, coalesce, time.time(), rate_keys, job_class, priority, 
+                self.job_timeout if timeout is None else timeout
+            )
+            if coalesce and job_queue and job_queue[0].coalesce:
+                # The replacement has been waiting since the job it replaces was queued
+                job.queued_time = job_queue[0].queued_time
+                job_queue[0] = job
+                self.n_coalesced += 1
+            elif job_queue:
+                job_queue.insert(0, job)
+            else:
+                self.queued[job_name] = [job]
+            self.pending = True
+            self.condition.notify()
+
+    def get_stats(self):
+        """Return the queue depth, job counters and job wait and run time histograms"""
+        with self.condition:
+            queued_classes = {job_class: 0 for job_class in self.class_wait_times}
+            for job_queue in self.queued.values():
+                for job in job_queue:
+                    job_class = job.job_class if job.job_class in JOB_CLASSES else "other"
+                    queued_classes[job_class] += 1
+            return {
+                "queued": sum(len(job_queue) for job_queue in self.queued.values()),
+                "queued_classes": queued_classes,
+                "queued_names": len(self.queued),
+                "active": len(self.active),
+                "coalesced": self.n_coalesced,
+                "failed": self.n_failed,
+                "timed_out": self.n_timed_out,
+                "retried": self.n_retried,
+                "hung": self.n_hung,
+                "wait_times": self.wait_times.snapshot(),
+                "run_times": self.run_times.snapshot(),
+                "class_wait_times": {
+                    job_class: wait_times.snapshot() 
+                    for job_class, wait_times in self.class_wait_times.items()
+                },
+                "throttled": len(self.throttled),
+                "limiter_wait_times": self.limiter_wait_times.snapshot(),
+                "limiter_throttled": dict(self.n_throttled),
+                "limiter_tokens": self.limiter.get_tokens() if self.limiter else {}
+            }
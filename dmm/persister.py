@@ -0,0 +1,91 @@
+import logging
+import time
+from threading import Thread, Event, Lock, Condition
+from dmm.sql.session import SQLSession
+import dmm.tracing as tracing
+
+class Persister:
+    """
+    Write-behind store of the state of every Request; updates are gathered in memory and
+    written to the database in one transaction every `interval` seconds, so handlers and
+    link jobs never wait on it
+
+    Only the latest state of each request is written, and a request that is deleted before
+    its state was written is never written at all
+    """
+    def __init__(self, url, interval=1):
+        self.sql_session = SQLSession(url)
+        self.interval = interval
+        self.dirty = {}
+        self.deleted = set()
+        self.n_writes = 0
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.__stop_event = Event()
+        self.thread = Thread(target=self.__start, daemon=True)
+        self.thread.name = "PersistThread"
+        self.thread.start()
+
+    def __start(self):
+        logging.debug(f"Persister started with a {self.interval}s interval")
+        while not self.__stop_event.is_set():
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.dirty or self.deleted or self.__stop_event.is_set()
+                )
+            # Let updates accumulate for the rest of the interval
+            self.__stop_event.wait(timeout=self.interval)
+            self.flush()
+
+    def put(self, request):
+        """Schedule the current state of a request to be written"""
+        record = request.to_record()
+        record["updated_at"] = time.time()
+        with self.condition:
+            self.dirty[request.request_id] = record
+            self.deleted.discard(request.request_id)
+            self.condition.notify()
+
+    def delete(self, request_id):
+        """Schedule the state of a request to be deleted"""
+        with self.condition:
+            self.dirty.pop(request_id, None)
+            self.deleted.add(request_id)
+            self.condition.notify()
+
+    def flush(self):
+        """Write every pending update to the database"""
+        with self.lock:
+            dirty, deleted = self.dirty, self.deleted
+            self.dirty, self.deleted = {}, set()
+        if not dirty and not deleted:
+            return
+        try:
+            with tracing.span("persist", n_written=len(dirty), n_deleted=len(deleted)):
+                if dirty:
+                    self.sql_session.write(dirty.values())
+                if deleted:
+                    self.sql_session.delete(deleted)
+            self.n_writes += 1
+            logging.debug(f"persisted {len(dirty)} requests and deleted {len(deleted)}")
+        except Exception as e:
+            logging.error(f"could not persist DMM state, dumping error\n{e}")
+            # Try again with the next batch, unless newer updates have superseded these
+            with self.lock:
+                for request_id, record in dirty.items():
+                    if request_id not in self.dirty and request_id not in self.deleted:
+                        self.dirty[request_id] = record
+                for request_id in deleted:
+                    if request_id not in self.dirty:
+                        self.deleted.add(request_id)
+
+    def load(self):
+        """Return the saved state of every request"""
+        return self.sql_session.load()
+
+    def stop(self):
+        with self.condition:
+            self.__stop_event.set()
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
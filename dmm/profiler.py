@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import logging
+import threading
+from threading import Thread, Event, Lock
+import dmm.tracing as tracing
+
+class Profiler:
+    """
+    Profiling session that can be switched on and off while DMM runs: spans are traced to
+    <out_dir>/dmm-<time>.trace.json, and the stacks of all threads are sampled every
+    `interval` seconds, then written to <out_dir>/dmm-<time>.folded as collapsed stacks
+    (one "thread;frame;frame;... count" line per distinct stack, as read by flamegraph.pl
+    or speedscope)
+
+    Note: while the session is off, nothing is sampled and every span is a no-op
+    """
+    def __init__(self, out_dir="profiles", interval=0.01):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.lock = Lock()
+        self.thread = None
+        self.prefix = ""
+        self.stacks = {}
+        self.n_samples = 0
+        self.__stop_event = Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def toggle(self):
+        """Start a profiling session if none is running, and stop it otherwise"""
+        with self.lock:
+            if self.running:
+                self.__stop()
+            else:
+                self.__start()
+
+    def __start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.prefix = os.path.join(self.out_dir, f"dmm-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.stacks = {}
+        self.n_samples = 0
+        self.__stop_event.clear()
+        tracing.start_tracing(f"{self.prefix}.trace.json")
+        self.thread = Thread(target=self.__sample, daemon=True)
+        self.thread.name = "ProfileThread"
+        self.thread.start()
+        logging.info(f"started profiling; sampling every {self.interval}s")
+
+    def __stop(self):
+        self.__stop_event.set()
+        self.thread.join()
+        self.thread = None
+        tracing.stop_tracing()
+        folded_path = f"{self.prefix}.folded"
+        with open(folded_path, "w") as f_out:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f_out.write(f"{stack} {count}\n")
+        logging.info(f"stopped profiling; wrote {self.n_samples} samples to {folded_path}")
+
+    def __sample(self):
+        own_ident = threading.get_ident()
+        while not self.__stop_event.wait(timeout=self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident == own_ident:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                frames.append(thread_names.get(thread_ident, str(thread_ident)))
+                stack = ";".join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.n_samples += 1
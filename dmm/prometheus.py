@@ -1,55 +1,163 @@
-import yaml
 import requests
 import logging
+import re
 import time
+from bisect import bisect_left
+from threading import Thread, Lock
+from dmm.config import get_config
+import dmm.tracing as tracing
+
+PROMETHEUS = None
+PROMETHEUS_LOCK = Lock()
+
+def get_prometheus():
+    """Return the Prometheus client shared by the whole process, creating it on first use"""
+    global PROMETHEUS
+    with PROMETHEUS_LOCK:
+        if PROMETHEUS is None:
+            PROMETHEUS = Prometheus()
+    return PROMETHEUS
 
 class Prometheus:
     """
     Get network metrics from Prometheus via its HTTP API and return aggregations of 
     those metrics
+
+    Note: thread-safe; queries share a pool of keep-alive connections, and the dev map is 
+          only queried once it is first needed
     """
-    def __init__(self) -> None:
-        with open("config.yaml", "r") as f_in:
-            prometheus_config = yaml.safe_load(f_in).get("prometheus")
-            prometheus_host = prometheus_config["host"]
-            prometheus_port = prometheus_config["port"]
+    def __init__(self, pool_size=16) -> None:
+        prometheus_config = get_config().prometheus
+        prometheus_host = prometheus_config.host
+        prometheus_port = prometheus_config.port
         self.prometheus_addr = f"http://{prometheus_host}:{prometheus_port}"
+        self.timeout = prometheus_config.timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # IPv6 --> (device, instance) index, refreshed in the background once it is older 
+        # than the TTL; addresses it does not contain are remembered for negative_ttl 
+        # seconds, and a miss never re-queries it more than once per refresh_interval
         self.dev_map = {}
-        # Update dev map if prometheus address is reachable
-        try:
-            self.update_dev_map() 
-        except requests.exceptions.ConnectionError as error:
-            logging.warning(f"Prometheus unreachable - {error}")
+        self.dev_map_time = None
+        self.dev_map_attempt_time = None
+        self.dev_map_ttl = prometheus_config.dev_map_ttl
+        self.dev_map_negative_ttl = prometheus_config.dev_map_negative_ttl
+        self.dev_map_refresh_interval = prometheus_config.dev_map_refresh_interval
+        self.unknown_addrs = {}
+        self.dev_map_lock = Lock()
+        self.dev_map_refresh_lock = Lock()
+        self.dev_map_refreshing = False
+        self.dev_map_hits = 0
+        self.dev_map_misses = 0
+        self.dev_map_negative_hits = 0
+        self.dev_map_refreshes = 0
 
     def submit_query(self, query_dict, endpoint="api/v1/query") -> dict:
         query_addr = f"{self.prometheus_addr}/{endpoint}"
-        return requests.get(query_addr, params=query_dict).json()
+        with tracing.span("prometheus query", query=query_dict["query"]):
+            return self.session.get(query_addr, params=query_dict, timeout=self.timeout).json()
         
     def update_dev_map(self) -> None:
         """Update IPv6 --> Device Name mapping"""
         response = self.submit_query({"query": "node_network_address_info"})
         if response["status"] == "success":
+            dev_map = {}
             for metric in response["data"]["result"]:
-                self.dev_map[metric["metric"]["address"]] = (metric["metric"]["device"], metric["metric"]["instance"])
+                dev_map[metric["metric"]["address"]] = (metric["metric"]["device"], metric["metric"]["instance"])
+            with self.dev_map_lock:
+                self.dev_map = dev_map
+                self.dev_map_time = time.time()
+                self.dev_map_refreshes += 1
+                for addr in list(self.unknown_addrs):
+                    if addr in dev_map:
+                        self.unknown_addrs.pop(addr)
+        else:
+            raise Exception("query node_network_address_info failed")
+
+    def __refresh_dev_map(self, last_refresh_time) -> None:
+        """Update the dev map unless another thread did so since last_refresh_time, or 
+        tried to do so less than refresh_interval seconds ago"""
+        with self.dev_map_refresh_lock:
+            if self.dev_map_time != last_refresh_time:
+                return
+            now = time.time()
+            last_attempt_time = self.dev_map_attempt_time
+            if last_attempt_time is not None:
+                if now - last_attempt_time < self.dev_map_refresh_interval:
+                    return
+            self.dev_map_attempt_time = now
+            self.update_dev_map()
+
+    def __background_refresh(self, last_refresh_time) -> None:
+        try:
+            self.__refresh_dev_map(last_refresh_time)
+        except Exception as e:
+            logging.warning(f"could not refresh dev map - {e}")
+        finally:
+            with self.dev_map_lock:
+                self.dev_map_refreshing = False
+
+    def get_dev_map_stats(self) -> dict:
+        """Return the size and hit/miss counters of the dev map"""
+        with self.dev_map_lock:
+            n_lookups = self.dev_map_hits + self.dev_map_misses + self.dev_map_negative_hits
+            return {
+                "size": len(self.dev_map),
+                "unknown": len(self.unknown_addrs),
+                "hits": self.dev_map_hits,
+                "misses": self.dev_map_misses,
+                "negative_hits": self.dev_map_negative_hits,
+                "refreshes": self.dev_map_refreshes,
+                "hit_rate": self.dev_map_hits/max(n_lookups, 1)
+            }
 
     @staticmethod 
     def get_val_from_response(response):
         """Extract desired value from typical location in Prometheus response"""
         return response["data"]["result"][0]["value"][1]
 
+    def get_device(self, ipv6):
+        """Returns the (device, instance) that a given ipv6 address belongs to
+
+        Note: a stale dev map is still used, but triggers a refresh in the background; a 
+              miss refreshes it synchronously, at most once every refresh_interval seconds
+        """
+        now = time.time()
+        with self.dev_map_lock:
+            last_refresh_time = self.dev_map_time
+            dev_addr_info = self.dev_map.get(ipv6)
+            if dev_addr_info is not None:
+                self.dev_map_hits += 1
+                stale = (now - last_refresh_time > self.dev_map_ttl)
+                if stale and not self.dev_map_refreshing:
+                    self.dev_map_refreshing = True
+                    refresh_thread = Thread(
+                        target=self.__background_refresh, args=(last_refresh_time,), daemon=True
+                    )
+                    refresh_thread.name = "DevMapThread"
+                    refresh_thread.start()
+                return dev_addr_info
+            unknown_since = self.unknown_addrs.get(ipv6)
+            if unknown_since is not None and now - unknown_since < self.dev_map_negative_ttl:
+                self.dev_map_negative_hits += 1
+                raise Exception(f"IPv6 {ipv6} does not exist")
+            self.dev_map_misses += 1
+        self.__refresh_dev_map(last_refresh_time)
+        with self.dev_map_lock:
+            dev_addr_info = self.dev_map.get(ipv6)
+            if dev_addr_info is None:
+                self.unknown_addrs[ipv6] = now
+                raise Exception(f"IPv6 {ipv6} does not exist")
+            return dev_addr_info
+
     def get_total_bytes_transmitted(self, ipv6, rse_name, start_time, end_time) -> float:
         """
         Returns the total number of bytes transmitted from a given Rucio RSE via a given
         ipv6 address
         """
-        try:
-            dev_addr_info = self.dev_map[ipv6]
-        except:
-            self.update_dev_map()
-        try:
-            dev_addr_info = self.dev_map[ipv6]
-        except:
-            raise Exception(f"IPv6 {ipv6} does not exist")
+        dev_addr_info = self.get_device(ipv6)
         params = f"device=\"{dev_addr_info[0]}\",instance=\"{dev_addr_info[1]}\",job=~\".*{rse_name}.*\""
         metric = f"node_network_transmit_bytes_total{{{params}}}"
         # Get bytes transferred at the start time
@@ -69,4 +177,117 @@ class Prometheus:
     def get_average_throughput(self, ipv6, rse_name, start_time, end_time) -> float:
         """Returns the total throughput from a given Rucio RSE via a given ipv6 address"""
         total_bytes = self.get_total_bytes_transmitted(ipv6, rse_name, start_time, end_time)
-        return total_bytes/(end_time - start_time)
\ No newline at end of file
+        return total_bytes/(end_time - start_time)
+
+    def get_transmit_counters(self, start_time, end_time, devices, rse_names, 
+                              max_points=1000) -> dict:
+        """
+        Returns the node_network_transmit_bytes_total samples between two times of the given 
+        (device, instance) pairs at the given Rucio RSEs, keyed by (device, instance), as a 
+        list of (job, [(time, bytes), ...]), using a single range query
+
+        Note: the selector matches any of the devices at any of the instances, so a few other 
+              devices may be returned too; the samples are spaced evenly, at most 
+              max_points + 1 per device and at most one per second unless the interval is 
+              shorter, so that one falls on each end
+        """
+        if not devices:
+            return {}
+        device_names = label_regex(device for device, _ in devices)
+        instances = label_regex(instance for _, instance in devices)
+        jobs = label_regex(rse_names)
+        params = f"device=~\"{device_names}\",instance=~\"{instances}\",job=~\".*({jobs}).*\""
+        duration = max(end_time - start_time, 1e-3)
+        step = duration/max(min(max_points, int(duration)), 1)
+        query_dict = {
+            "query": f"node_network_transmit_bytes_total{{{params}}}",
+            "start": start_time,
+            "end": end_time,
+            "step": step
+        }
+        response = self.submit_query(query_dict, endpoint="api/v1/query_range")
+        if response["status"] != "success":
+            raise Exception(f"query {query_dict['query']} failed")
+        counters = {}
+        for result in response["data"]["result"]:
+            labels = result["metric"]
+            dev_addr_info = (labels["device"], labels["instance"])
+            samples = [(float(t), float(val)) for t, val in result["values"]]
+            counters.setdefault(dev_addr_info, []).append((labels.get("job", ""), samples))
+        return counters
+
+def label_regex(values):
+    """Return a PromQL label regex, as it goes between double quotes, that matches any of 
+    the given values exactly"""
+    regex = "|".join(re.escape(value) for value in sorted(set(values)))
+    return regex.replace("\\", "\\\\").replace("\"", "\\\"")
+
+def interpolate(samples, at_time):
+    """Return the value of a counter at a given time from its (time, value) samples"""
+    times = [t for t, _ in samples]
+    sample_i = bisect_left(times, at_time)
+    if sample_i == 0:
+        return samples[0][1]
+    if sample_i == len(samples):
+        return samples[-1][1]
+    (t_0, val_0), (t_1, val_1) = samples[sample_i - 1], samples[sample_i]
+    return val_0 + (val_1 - val_0)*(at_time - t_0)/(t_1 - t_0)
+
+class Throughputs:
+    """
+    Transmitted byte counters since a given time of the network devices of the given 
+    (ipv6, rse_name) links, shared by all of the link updates of one reallocation round; 
+    the query is only sent when the first of them needs it, and only once, and each link 
+    reads its throughput over its own interval
+    """
+    def __init__(self, prometheus, start_time, links):
+        self.prometheus = prometheus
+        self.start_time = start_time
+        self.links = links
+        self.end_time = None
+        self.counters = None
+        self.lock = Lock()
+
+    def get(self, ipv6, rse_name, start_time, end_time) -> float:
+        """Returns the average throughput from a given Rucio RSE via a given ipv6 address 
+        between two times, or -1 if it is unknown
+
+        Note: the interval is cut short at the time the counters were queried
+        """
+        with self.lock:
+            if self.counters is None:
+                self.end_time = time.time()
+                devices = set()
+                for link_ipv6, _ in self.links:
+                    try:
+                        devices.add(self.prometheus.get_device(link_ipv6))
+                    except Exception:
+                        # Reported by the link update that needs it, below
+                        continue
+                try:
+                    self.counters = self.prometheus.get_transmit_counters(
+                        self.start_time, 
+                        self.end_time,
+                        devices,
+                        {rse_name for _, rse_name in self.links}
+                    )
+                except Exception as e:
+                    logging.error(f"batched throughput query failed - {e}")
+                    self.counters = {}
+        try:
+            dev_addr_info = self.prometheus.get_device(ipv6)
+        except Exception as e:
+            logging.warning(f"no throughput for {ipv6} - {e}")
+            return -1
+        start_time = max(start_time, self.start_time)
+        end_time = min(end_time, self.end_time)
+        for job, samples in self.counters.get(dev_addr_info, []):
+            # Same selector as Prometheus.get_total_bytes_transmitted
+            if not re.fullmatch(f".*{rse_name}.*", job) or not samples:
+                continue
+            if end_time <= start_time:
+                return -1
+            total_bytes = interpolate(samples, end_time) - interpolate(samples, start_time)
+            return total_bytes/(end_time - start_time)
+        logging.warning(f"no throughput for {ipv6} at {rse_name}")
+        return -1
@@ -0,0 +1,28 @@
+import json
+import logging
+import time
+from threading import Lock
+
+class Recorder:
+    """
+    Append every message received from the Rucio daemons to a JSONL trace, one
+    {"time": ..., "daemon": ..., "payload": ...} object per line, so that the load can be 
+    replayed later (see bench/replay.py)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.n_records = 0
+        self.file = open(self.path, "a")
+        logging.info(f"recording Rucio daemon messages to {self.path}")
+
+    def record(self, daemon, payload):
+        line = json.dumps({"time": time.time(), "daemon": daemon, "payload": payload})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.n_records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
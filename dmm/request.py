@@ -1,10 +1,21 @@
+import os
+import logging
 import time
 import dmm.sense_api as sense_api
-from dmm.prometheus import Prometheus
+import dmm.sense_aio as sense_aio
+from dmm.prometheus import get_prometheus
+from dmm.history import History
 
 class Request:
+    __slots__ = (
+        "request_id", "rule_id", "src_site", "dst_site", "n_transfer_ids", "priority", 
+        "n_bytes_total", "n_bytes_transferred", "n_transfers_total", "n_transfers_submitted", 
+        "n_transfers_finished", "best_effort", "waiting", "link_is_open", "src_ipv6", 
+        "dst_ipv6", "bandwidth", "history", "sense_link_id", "theoretical_bandwidth"
+    )
+
     def __init__(self, rule_id, src_site, dst_site, transfer_ids, priority, 
-                 n_bytes_total, n_transfers_total):
+                 n_bytes_total, n_transfers_total, history_size=64, history_spill_dir=None):
         # General attributes
         self.request_id = Request.id(rule_id, src_site.rse_name, dst_site.rse_name)
         self.rule_id = rule_id
@@ -12,7 +23,7 @@ class Request:
         self.dst_site = dst_site # DMM Site object
 
         # Attributes unpacked from prepared_request["attr"]
-        self.transfer_ids = transfer_ids
+        self.n_transfer_ids = len(transfer_ids) # the IDs themselves are not needed
         self.priority = priority
         self.n_bytes_total = n_bytes_total
         self.n_bytes_transferred = 0
@@ -22,12 +33,17 @@ class Request:
 
         # SENSE link attributes
         self.best_effort = (self.priority == 0)
+        self.waiting = False # waiting for an IPv6 block at one of its sites
         self.link_is_open = False
         self.src_ipv6 = ""
         self.dst_ipv6 = ""
         self.bandwidth = 0
-        self.history = [(time.time(), self.bandwidth, 0, "init")]
-        self.prometheus = Prometheus()
+        if history_spill_dir:
+            history_spill_path = os.path.join(history_spill_dir, f"{self.request_id}.jsonl")
+        else:
+            history_spill_path = None
+        self.history = History(size=history_size, spill_path=history_spill_path)
+        self.history.append(time.time(), self.bandwidth, 0, "init")
         self.sense_link_id = ""
         self.theoretical_bandwidth = -1
 
@@ -38,34 +54,97 @@ class Request:
     def __str__(self):
         return f"Request({self.request_id})"
 
-    def update_history(self, msg, monitoring=False):
-        """Track the promised and actual bandwidth"""
-        time_last, _, _, _ = self.history[-1]
+    def to_record(self):
+        """Return the state of this request that should survive a restart"""
+        return {
+            "request_id": self.request_id,
+            "rule_id": self.rule_id,
+            "src_rse_name": self.src_site.rse_name,
+            "dst_rse_name": self.dst_site.rse_name,
+            "priority": self.priority,
+            "n_bytes_total": self.n_bytes_total,
+            "n_bytes_transferred": self.n_bytes_transferred,
+            "n_transfers_total": self.n_transfers_total,
+            "n_transfers_submitted": self.n_transfers_submitted,
+            "n_transfers_finished": self.n_transfers_finished,
+            "n_transfer_ids": self.n_transfer_ids,
+            "waiting": self.waiting,
+            "link_is_open": self.link_is_open,
+            "src_ipv6": self.src_ipv6,
+            "dst_ipv6": self.dst_ipv6,
+            "bandwidth": self.bandwidth,
+            "sense_link_id": self.sense_link_id,
+            "theoretical_bandwidth": self.theoretical_bandwidth
+        }
+
+    def restore(self, record):
+        """Restore the state returned by Request.to_record() and register the request at 
+        its sites again, reclaiming the IPv6 blocks it had reserved
+
+        Note: same caveats as Request.register()
+        """
+        for key in ["n_bytes_transferred", "n_transfers_submitted", "n_transfers_finished", 
+                    "n_transfer_ids", "link_is_open", "bandwidth", "sense_link_id", 
+                    "theoretical_bandwidth"]:
+            setattr(self, key, record[key])
+        if self.best_effort or record["waiting"]:
+            return self.register()
+        src_ipv6 = self.src_site.claim_ipv6(record["src_ipv6"])
+        if src_ipv6 is None:
+            return self.__readmit()
+        dst_ipv6 = self.dst_site.claim_ipv6(record["dst_ipv6"])
+        if dst_ipv6 is None:
+            self.src_site.free_ipv6(src_ipv6)
+            return self.__readmit()
+        self.src_ipv6 = src_ipv6
+        self.dst_ipv6 = dst_ipv6
+        self.src_site.add_request(self.dst_site.rse_name, self.priority)
+        self.dst_site.add_request(self.src_site.rse_name, self.priority)
+        return True
+
+    def __readmit(self):
+        """Register a restored request whose IPv6 blocks could not be claimed as if it were 
+        new; its link, if any, was set up for other blocks, so it is marked as closed, which 
+        has the link reconciler delete it"""
+        self.link_is_open = False
+        return self.register()
+
+    def update_history(self, msg, monitoring=False, throughputs=None):
+        """Track the promised and actual bandwidth
+
+        Note: if a Throughputs snapshot is given, the actual bandwidth is read from it 
+              instead of being queried from Prometheus for this request alone
+        """
+        time_last, _, _, _ = self.history.last()
         time_now = time.time()
         if monitoring:
-            actual_bandwidth = self.prometheus.get_average_throughput(
-                self.src_site.block_to_ipv6[self.src_ipv6].split(']')[0][1:],
-                self.src_site.rse_name,
-                time_last,
-                time_now
-            )
+            src_addr = self.get_src_addr()
+            if throughputs is not None:
+                actual_bandwidth = throughputs.get(
+                    src_addr,
+                    self.src_site.rse_name,
+                    time_last,
+                    time_now
+                )
+            else:
+                actual_bandwidth = get_prometheus().get_average_throughput(
+                    src_addr,
+                    self.src_site.rse_name,
+                    time_last,
+                    time_now
+                )
         else:
             actual_bandwidth = -1
-        self.history.append((time_now, self.bandwidth, actual_bandwidth, msg))
+        self.history.append(time_now, self.bandwidth, actual_bandwidth, msg)
 
     def get_summary(self, string=False, monitoring=False):
-        """Return the average promised and actual bandwidth"""
-        times, promised_bw, actual_bw, _ = zip(*self.history)
-        dts = [t - times[t_i] for t_i, t in enumerate(times[1:])]
-        avg_promise = sum([bw*dt for bw, dt in zip(promised_bw, dts)])/sum(dts)
-        if monitoring:
-            avg_actual = self.prometheus.get_average_throughput(
-                self.src_site.block_to_ipv6[self.src_ipv6], # block_to_ipv6 is a temporary hack
-                self.src_site.rse_name,
-                times[1], # times[1] is when the link is actually provisioned
-                times[-1]
-            )
-        else:
+        """Return the average promised and actual bandwidth
+
+        Note: the actual bandwidth is averaged over the measurements already recorded in the 
+              history since the link was provisioned, so no query is needed
+        """
+        avg_promise, avg_actual = self.history.summary()
+        if not monitoring:
             avg_actual = -1
         if string:
             return f"{avg_promise:0.1f}, {avg_actual:0.1f} (promised, actual bandwidth [Mb/s])"
@@ -75,35 +154,102 @@ class Request:
     def register(self):
         """Register new request at the source and destination sites
 
+        Returns False if the request has to wait for an IPv6 block to be freed at one of 
+        its sites, in which case it is registered once it is admitted
+
         Note: cannot be run in parallel with another Request.register() because it would 
               incur a race condition; both instances need to modify a list at their 
               source/destination sites, so we specifically get a race condition if they 
               share either of the same endpoints.
         """
-        self.src_site.add_request(self.dst_site.rse_name, self.priority)
-        self.dst_site.add_request(self.src_site.rse_name, self.priority)
         if self.best_effort:
+            self.src_site.add_request(self.dst_site.rse_name, self.priority)
+            self.dst_site.add_request(self.src_site.rse_name, self.priority)
             self.src_ipv6 = self.src_site.default_ipv6
             self.dst_ipv6 = self.dst_site.default_ipv6
+            return True
         else:
-            self.src_ipv6 = self.src_site.reserve_ipv6()
-            self.dst_ipv6 = self.dst_site.reserve_ipv6()
+            return self.admit()
+
+    def admit(self):
+        """Reserve an IPv6 block at both sites and register the request there, or queue it 
+        at the first site that has no block left; returns whether it was admitted
+
+        Note: same caveats as Request.register()
+        """
+        if self.src_site is self.dst_site and len(self.src_site.free_ipv6_pool) < 2:
+            # Needs a block for each end of the link at the same site
+            self.src_site.waiting_requests.append(self)
+            self.waiting = True
+            return False
+        src_ipv6 = self.src_site.reserve_ipv6()
+        if src_ipv6 is None:
+            self.src_site.waiting_requests.append(self)
+            self.waiting = True
+            return False
+        dst_ipv6 = self.dst_site.reserve_ipv6()
+        if dst_ipv6 is None:
+            self.src_site.free_ipv6(src_ipv6)
+            self.dst_site.waiting_requests.append(self)
+            self.waiting = True
+            return False
+        self.src_ipv6 = src_ipv6
+        self.dst_ipv6 = dst_ipv6
+        self.src_site.add_request(self.dst_site.rse_name, self.priority)
+        self.dst_site.add_request(self.src_site.rse_name, self.priority)
+        self.waiting = False
+        return True
 
     def deregister(self):
         """Deregister new request at the source and destination sites
 
+        Returns the waiting requests that were admitted with the IPv6 blocks it freed
+
         Note: cannot be run in parallel with another Request.deregister() because it would 
               incur a race condition; both instances need to modify a list at their 
               source/destination sites, so we specifically get a race condition if they 
               share either of the same endpoints.
         """
+        if self.waiting:
+            # Never admitted, so there is nothing to release
+            for site in (self.src_site, self.dst_site):
+                if self in site.waiting_requests:
+                    site.waiting_requests.remove(self)
+            self.waiting = False
+            return []
         self.src_site.remove_request(self.dst_site.rse_name, self.priority)
         self.dst_site.remove_request(self.src_site.rse_name, self.priority)
+        admitted = []
         if not self.best_effort:
             self.src_site.free_ipv6(self.src_ipv6)
             self.dst_site.free_ipv6(self.dst_ipv6)
+            admitted += self.src_site.admit_waiting_requests()
+            admitted += self.dst_site.admit_waiting_requests()
         self.src_ipv6 = ""
         self.dst_ipv6 = ""
+        return admitted
+
+    def update_priority(self, priority):
+        """Change the priority of this request and update the priority sums at its sites
+
+        Note: same caveats as Request.register()
+        """
+        if self.waiting:
+            self.priority = priority
+            return
+        self.src_site.remove_request(self.dst_site.rse_name, self.priority)
+        self.dst_site.remove_request(self.src_site.rse_name, self.priority)
+        self.priority = priority
+        self.src_site.add_request(self.dst_site.rse_name, self.priority)
+        self.dst_site.add_request(self.src_site.rse_name, self.priority)
+
+    def get_src_addr(self):
+        """Return the IPv6 address that transfers leave the source site from"""
+        return self.src_site.block_to_ipv6[self.src_ipv6].split(']')[0][1:]
+
+    def get_sense_names(self):
+        """Return the SENSE URIs of the source and destination sites"""
+        return (self.src_site.sense_name, self.dst_site.sense_name)
 
     def get_max_bandwidth(self):
         if self.best_effort:
@@ -127,13 +273,21 @@ class Request:
         else:
             return self.priority/self.src_site.prio_sums.get(self.dst_site.rse_name)
 
-    def reprovision_link(self):
-        """Reprovision SENSE link
+    def get_target_bandwidth(self):
+        """Return the bandwidth provision this link should have given the current priorities"""
+        return int(self.get_max_bandwidth()*self.get_bandwidth_fraction())
+
+    def reprovision_link(self, bandwidth=None):
+        """Reprovision SENSE link with the given bandwidth, or with the target bandwidth 
+        computed from the current priorities if none is given
 
         Note: can be run in parallel, only modifies itself
         """
         old_bandwidth = self.bandwidth
-        new_bandwidth = int(self.get_max_bandwidth()*self.get_bandwidth_fraction())
+        if bandwidth is None:
+            new_bandwidth = self.get_target_bandwidth()
+        else:
+            new_bandwidth = bandwidth
         if not self.best_effort and new_bandwidth != old_bandwidth:
             # Update SENSE link; note: in the future, this should not change the link ID
             self.sense_link_id = sense_api.reprovision_link(
@@ -146,13 +300,20 @@ class Request:
                 alias=self.request_id
             )
             self.bandwidth = new_bandwidth
+            self.__discard_if_deregistered()
 
-    def open_link(self):
-        """Create SENSE link
+    def open_link(self, bandwidth=None):
+        """Create SENSE link with the given bandwidth (capped by the theoretical bandwidth), 
+        or with the target bandwidth computed from the current priorities if none is given
 
         Note: can be run in parallel, only modifies itself
         """
         if not self.best_effort:
+            if self.sense_link_id:
+                # Left behind by an earlier attempt that failed or was cancelled after staging
+                logging.warning(f"deleting leftover SENSE link {self.sense_link_id} of {self}")
+                sense_api.delete_link(self.sense_link_id)
+                self.sense_link_id = ""
             # Initialize SENSE link and get theoretical bandwidth
             self.sense_link_id, self.theoretical_bandwidth = sense_api.stage_link(
                 self.src_site.sense_name,
@@ -161,8 +322,13 @@ class Request:
                 self.dst_ipv6,
                 alias=self.request_id
             )
+            if self.__discard_if_deregistered():
+                return
             # Get bandwidth provisioning
-            self.bandwidth = int(self.get_max_bandwidth()*self.get_bandwidth_fraction())
+            if bandwidth is None:
+                self.bandwidth = self.get_target_bandwidth()
+            else:
+                self.bandwidth = min(bandwidth, int(self.theoretical_bandwidth))
             # Provision link
             sense_api.provision_link(
                 self.sense_link_id, 
@@ -173,17 +339,103 @@ class Request:
                 self.bandwidth,
                 alias=self.request_id
             )
+            if self.__discard_if_deregistered():
+                return
 
         self.link_is_open = True
 
+    def __discard_if_deregistered(self):
+        """Delete the SENSE link just created for this request if it was deregistered (i.e. 
+        finished) in the meantime; returns whether it was
+
+        Note: an update that runs past its timeout is abandoned to its worker thread, so 
+              the link closer may run while it is still staging a link, in which case the 
+              closer has no link to delete and the new one would otherwise be leaked
+        """
+        if self.src_ipv6:
+            return False
+        logging.warning(f"{self} | deregistered while its link was being updated; deleting it")
+        self.close_link()
+        return True
+
+    async def __discard_if_deregistered_async(self):
+        """Same as Request.__discard_if_deregistered, but with the asyncio SENSE client"""
+        if self.src_ipv6:
+            return False
+        logging.warning(f"{self} | deregistered while its link was being updated; deleting it")
+        await self.close_link_async()
+        return True
+
     def close_link(self):
         """Close SENSE link
 
         Note: can be run in parallel, only modifies itself
         """
-        if not self.best_effort:
+        if not self.best_effort and self.sense_link_id:
             sense_api.delete_link(self.sense_link_id)
             self.sense_link_id = ""
             self.theoretical_bandwidth = -1
 
         self.link_is_open = False
+
+    async def reprovision_link_async(self, bandwidth=None):
+        """Same as Request.reprovision_link, but with the asyncio SENSE client"""
+        if bandwidth is None:
+            new_bandwidth = self.get_target_bandwidth()
+        else:
+            new_bandwidth = bandwidth
+        if not self.best_effort and new_bandwidth != self.bandwidth:
+            self.sense_link_id = await sense_aio.reprovision_link(
+                self.sense_link_id, 
+                self.src_site.sense_name,
+                self.dst_site.sense_name,
+                self.src_ipv6,
+                self.dst_ipv6,
+                new_bandwidth,
+                alias=self.request_id
+            )
+            self.bandwidth = new_bandwidth
+            await self.__discard_if_deregistered_async()
+
+    async def open_link_async(self, bandwidth=None):
+        """Same as Request.open_link, but with the asyncio SENSE client"""
+        if not self.best_effort:
+            if self.sense_link_id:
+                logging.warning(f"deleting leftover SENSE link {self.sense_link_id} of {self}")
+                await sense_aio.delete_link(self.sense_link_id)
+                self.sense_link_id = ""
+            self.sense_link_id, self.theoretical_bandwidth = await sense_aio.stage_link(
+                self.src_site.sense_name,
+                self.dst_site.sense_name,
+                self.src_ipv6,
+                self.dst_ipv6,
+                alias=self.request_id
+            )
+            if await self.__discard_if_deregistered_async():
+                return
+            if bandwidth is None:
+                self.bandwidth = self.get_target_bandwidth()
+            else:
+                self.bandwidth = min(bandwidth, int(self.theoretical_bandwidth))
+            await sense_aio.provision_link(
+                self.sense_link_id, 
+                self.src_site.sense_name,
+                self.dst_site.sense_name,
+                self.src_ipv6,
+                self.dst_ipv6,
+                self.bandwidth,
+                alias=self.request_id
+            )
+            if await self.__discard_if_deregistered_async():
+                return
+
+        self.link_is_open = True
+
+    async def close_link_async(self):
+        """Same as Request.close_link, but with the asyncio SENSE client"""
+        if not self.best_effort and self.sense_link_id:
+            await sense_aio.delete_link(self.sense_link_id)
+            self.sense_link_id = ""
+            self.theoretical_bandwidth = -1
+
+        self.link_is_open = False
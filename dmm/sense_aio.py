@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import dmm.sense_api as sense_api
+import dmm.tracing as tracing
+from dmm.config import get_config
+
+# Threads that send the (blocking) HTTP requests of the SENSE client, one per request in flight
+EXECUTOR = None
+EXECUTOR_LOCK = Lock()
+THREAD_IDS = itertools.count()
+# Limits the number of SENSE requests in flight, across every link operation of the loop
+SEMAPHORE = None
+# Value of sense.max_in_flight that the executor and the semaphore were sized with
+MAX_IN_FLIGHT = None
+
+def name_thread():
+    threading.current_thread().name = f"SENSEThread-{next(THREAD_IDS):02d}"
+
+def resize(max_in_flight):
+    """Rebuild the executor and the semaphore if sense.max_in_flight has changed
+
+    Note: requests already in flight finish on the old executor and semaphore, so the limit
+          may be exceeded until they do
+    """
+    global EXECUTOR, SEMAPHORE, MAX_IN_FLIGHT
+    if max_in_flight == MAX_IN_FLIGHT:
+        return
+    if EXECUTOR is not None:
+        logging.info(f"resizing SENSE client from {MAX_IN_FLIGHT} to {max_in_flight} requests in flight")
+        EXECUTOR.shutdown(wait=False)
+    EXECUTOR = ThreadPoolExecutor(max_workers=max_in_flight, initializer=name_thread)
+    SEMAPHORE = None
+    MAX_IN_FLIGHT = max_in_flight
+
+def get_executor():
+    with EXECUTOR_LOCK:
+        resize(get_config().sense.max_in_flight)
+        return EXECUTOR
+
+def get_semaphore():
+    global SEMAPHORE
+    with EXECUTOR_LOCK:
+        resize(get_config().sense.max_in_flight)
+        if SEMAPHORE is None:
+            SEMAPHORE = asyncio.Semaphore(MAX_IN_FLIGHT)
+        return SEMAPHORE
+
+def timed(func):
+    """Record the number of calls, failures and total latency of an asynchronous SENSE
+    operation alongside those of its blocking counterpart in dmm.sense_api"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        failed = True
+        try:
+            result = await func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            sense_api.record_call(func.__name__, time.perf_counter() - start_time, failed)
+    return wrapper
+
+def traced(name, func, args, kwargs):
+    with tracing.span(f"sense {name}"):
+        return func(*args, **kwargs)
+
+async def call(func, *args, retry=True, **kwargs):
+    """Send one SENSE request without blocking the event loop, retrying it with exponential
+    backoff and full jitter if it fails and retry is True
+
+    Note: a failed request may still have been carried out by SENSE (e.g. if the response 
+          was lost), so only requests that are safe to repeat, such as status queries, 
+          should be retried; the backoff sleep does not count against max_in_flight
+    """
+    sense_config = get_config().sense
+    retries = sense_config.retries if retry else 0
+    backoff_base = sense_config.backoff_base
+    backoff_max = sense_config.backoff_max
+    loop = asyncio.get_running_loop()
+    blocking_call = functools.partial(traced, func.__name__, func, args, kwargs)
+    for attempt_i in range(retries + 1):
+        async with get_semaphore():
+            try:
+                return await loop.run_in_executor(get_executor(), blocking_call)
+            except Exception as e:
+                if attempt_i == retries:
+                    raise
+                error = e
+        delay = random.uniform(0, min(backoff_max, backoff_base*2**attempt_i))
+        logging.warning(
+            f"SENSE request {func.__name__} failed (attempt {attempt_i + 1}/{retries + 1}); "
+            f"retrying in {delay:0.2f}s - {error}"
+        )
+        await asyncio.sleep(delay)
+
+async def wait_until(workflow_api, instance_uuid, is_ready):
+    """Poll the status of a service instance until is_ready(status) is True, doubling the
+    time between polls from poll_interval up to poll_max_interval seconds"""
+    sense_config = get_config().sense
+    interval = sense_config.poll_interval
+    max_interval = sense_config.poll_max_interval
+    deadline = time.time() + sense_config.operate_timeout
+    while True:
+        status = await call(workflow_api.instance_get_status, si_uuid=instance_uuid)
+        logging.debug(status)
+        if "error" in status:
+            raise ValueError(status)
+        if is_ready(status):
+            return status
+        if "FAILED" in status:
+            raise Exception(f"operation on {instance_uuid} failed with status '{status}'")
+        if time.time() + interval > deadline:
+            raise TimeoutError(f"operation on {instance_uuid} still '{status}'; gave up")
+        await asyncio.sleep(interval)
+        interval = min(2*interval, max_interval)
+
+async def operate(workflow_api, instance_uuid, action, is_ready, force="false"):
+    """Start an operation on a service instance, then wait for it to finish"""
+    await call(
+        workflow_api.instance_operate,
+        action,
+        retry=False,
+        si_uuid=instance_uuid,
+        sync="false",
+        force=force
+    )
+    return await wait_until(workflow_api, instance_uuid, is_ready)
+
+@timed
+async def stage_link(src_uri, dst_uri, src_ipv6, dst_ipv6, alias=""):
+    """Asynchronous version of dmm.sense_api.stage_link"""
+    workflow_api = await call(sense_api.get_workflow_api)
+    instance_uuid = await call(workflow_api.instance_new, retry=False)
+    intent = sense_api.get_stage_intent(src_uri, dst_uri, src_ipv6, dst_ipv6, alias=alias)
+    response = await call(workflow_api.instance_create, json.dumps(intent), retry=False)
+    logging.debug(response)
+    return sense_api.parse_stage_response(response, instance_uuid)
+
+@timed
+async def provision_link(instance_uuid, src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidth,
+                         alias=""):
+    """Asynchronous version of dmm.sense_api.provision_link"""
+    workflow_api = await call(sense_api.get_workflow_api)
+    workflow_api.si_uuid = instance_uuid
+    intent = sense_api.get_provision_intent(
+        src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidth, alias=alias
+    )
+    response = await call(workflow_api.instance_create, json.dumps(intent), retry=False)
+    logging.debug(response)
+    if not sense_api.good_response(response):
+        raise ValueError(f"SENSE query failed for {instance_uuid}")
+    await operate(
+        workflow_api,
+        instance_uuid,
+        "provision",
+        lambda status: "READY" in status and "CANCEL" not in status
+    )
+
+@timed
+async def delete_link(instance_uuid):
+    """Asynchronous version of dmm.sense_api.delete_link"""
+    workflow_api = await call(sense_api.get_workflow_api)
+    status = await call(workflow_api.instance_get_status, si_uuid=instance_uuid)
+    logging.debug(status)
+    if "error" in status:
+        raise ValueError(status)
+    if "CREATE" not in status and "REINSTATE" not in status and "MODIFY" not in status:
+        raise ValueError(f"cannot cancel an instance in status '{status}'")
+    await operate(
+        workflow_api,
+        instance_uuid,
+        "cancel",
+        lambda status: "CANCEL - READY" in status,
+        force=str("READY" not in status).lower()
+    )
+    await call(workflow_api.instance_delete, si_uuid=instance_uuid, retry=False)
+
+@timed
+async def reprovision_link(old_instance_uuid, src_uri, dst_uri, src_ipv6, dst_ipv6,
+                           new_bandwidth, alias=""):
+    """Asynchronous version of dmm.sense_api.reprovision_link"""
+    await delete_link(old_instance_uuid)
+    new_instance_uuid, _ = await stage_link(src_uri, dst_uri, src_ipv6, dst_ipv6, alias=alias)
+    await provision_link(
+        new_instance_uuid,
+        src_uri,
+        dst_uri,
+        src_ipv6,
+        dst_ipv6,
+        new_bandwidth,
+        alias=alias
+    )
+    return new_instance_uuid
@@ -1,28 +1,153 @@
 import json
-import yaml
 import re
+import time
 import logging
+import functools
+import requests
+from threading import Lock
 from sense.client.workflow_combined_api import WorkflowCombinedApi
 from sense.client.profile_api import ProfileApi
 from sense.client.discover_api import DiscoverApi
+from sense.client.apiclient import ApiClient
+from sense.client.requestwrapper import RequestWrapper
+from dmm.config import get_config
+from dmm.stats import Histogram
+import dmm.tracing as tracing
 
-PROFILE_UUID = ""
+# Overrides sense.pool_clients in config.yaml if set
+POOL_CLIENTS = None
+REQUEST_WRAPPER = None
+REQUEST_WRAPPER_LOCK = Lock()
+CALL_STATS = {}
+CALL_STATS_LOCK = Lock()
+
+class PooledRequestWrapper(RequestWrapper):
+    """
+    SENSE request wrapper that is authenticated once and sends every request through the 
+    same keep-alive HTTP session; can be shared by all threads
+    """
+    def __init__(self, pool_size=16):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.token_lock = Lock()
+        super().__init__()
+
+    def _refresh(self, config):
+        """Authenticate again, unless another thread already has since config was read
+
+        Note: the new config and token are built on a separate client and swapped in at 
+              once, so other threads never read a config without headers
+        """
+        with self.token_lock:
+            if self.config is config:
+                client = ApiClient()
+                self.token, self.config = client.token, client.config
+
+    def _send(self, method, api_path, **kwargs):
+        config = self.config
+        out = self.session.request(
+            method, config["REST_API"] + api_path, headers=config["headers"], 
+            verify=config["verify"], **kwargs
+        )
+        if out.status_code == 401:
+            self._refresh(config)
+            config = self.config
+            out = self.session.request(
+                method, config["REST_API"] + api_path, headers=config["headers"], 
+                verify=config["verify"], **kwargs
+            )
+        return out
+
+    def _get(self, api_path, params):
+        return self._send("GET", api_path, params=params)
+
+    def _put(self, api_path, data, params):
+        return self._send("PUT", api_path, data=data, params=params)
+
+    def _post(self, api_path, data, params):
+        return self._send("POST", api_path, data=data, params=params)
+
+    def _delete(self, api_path, params):
+        return self._send("DELETE", api_path, params=params)
 
 def get_profile_uuid():
-    global PROFILE_UUID
-    if PROFILE_UUID == "":
-        with open("config.yaml", "r") as f_in:
-            sense_config = yaml.safe_load(f_in).get("sense")
-            PROFILE_UUID = sense_config.get("profile_uuid")
+    return get_config().sense.profile_uuid
+
+def get_request_wrapper():
+    """
+    Return the request wrapper shared by all SENSE API clients, or None if client pooling 
+    is disabled, in which case every client authenticates and connects on its own
+    """
+    global REQUEST_WRAPPER
+    if POOL_CLIENTS is None:
+        pool_clients = get_config().sense.pool_clients
+    else:
+        pool_clients = POOL_CLIENTS
+    if not pool_clients:
+        return None
+    with REQUEST_WRAPPER_LOCK:
+        if REQUEST_WRAPPER is None:
+            # Keep a connection for every request the asyncio client may have in flight
+            pool_size = max(16, get_config().sense.max_in_flight)
+            REQUEST_WRAPPER = PooledRequestWrapper(pool_size=pool_size)
+    return REQUEST_WRAPPER
+
+def get_discover_api():
+    return DiscoverApi(req_wrapper=get_request_wrapper())
+
+def get_workflow_api():
+    return WorkflowCombinedApi(req_wrapper=get_request_wrapper())
+
+def timed(func):
+    """Record the number of calls, failures and total latency of a SENSE API function"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        failed = True
+        try:
+            with tracing.span(f"sense {func.__name__}"):
+                result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            record_call(func.__name__, time.perf_counter() - start_time, failed)
+    return wrapper
+
+def record_call(name, latency, failed):
+    with CALL_STATS_LOCK:
+        stats = CALL_STATS.get(name)
+        if stats is None:
+            stats = {"calls": 0, "errors": 0, "total_time": 0, "max_time": 0}
+            stats["latency"] = Histogram()
+            CALL_STATS[name] = stats
+        stats["calls"] += 1
+        stats["errors"] += failed
+        stats["total_time"] += latency
+        stats["max_time"] = max(stats["max_time"], latency)
+        stats["latency"].observe(latency)
 
-    return PROFILE_UUID
+def get_call_stats(reset=False):
+    """Return the number of calls, failures and latencies (in seconds) of each function, 
+    including a histogram of the latencies"""
+    global CALL_STATS
+    with CALL_STATS_LOCK:
+        call_stats = {name: dict(stats) for name, stats in CALL_STATS.items()}
+        if reset:
+            CALL_STATS = {}
+    for stats in call_stats.values():
+        stats["avg_time"] = stats["total_time"]/stats["calls"]
+        stats["latency"] = stats["latency"].snapshot()
+    return call_stats
 
 def good_response(response):
     return len(response) > 0 and "ERROR" not in response and "error" not in response
 
+@timed
 def get_ipv6_pool(uri):
     """Return a list of IPv6 subnets at given site"""
-    discover_api = DiscoverApi()
+    discover_api = get_discover_api()
     response = discover_api.discover_domain_id_ipv6pool_get(uri)
     logging.debug(response)
     if len(response) == 0 or "ERROR" in response:
@@ -31,9 +156,10 @@ def get_ipv6_pool(uri):
         response = json.loads(response)
         return response["routing"][0]["ipv6_subnet_pool"].split(",")
 
+@timed
 def get_uplink_capacity(uri):
     """Return the maximum uplink capacity in Mb/s for a given site"""
-    discover_api = DiscoverApi()
+    discover_api = get_discover_api()
     response = discover_api.discover_domain_id_peers_get(uri)
     logging.debug(response)
     if not good_response(response):
@@ -42,9 +168,10 @@ def get_uplink_capacity(uri):
         response = json.loads(response)
         return float(response["peer_points"][0]["port_capacity"])
 
+@timed
 def get_uri(rse_name, regex=".*?", full=False):
     """Return the SENSE URI for a given Rucio RSE"""
-    discover_api = DiscoverApi()
+    discover_api = get_discover_api()
     response = discover_api.discover_lookup_name_get(rse_name, search="NetworkAddress")
     logging.debug(response)
     if not good_response(response):
@@ -66,26 +193,35 @@ def get_uri(rse_name, regex=".*?", full=False):
             else:
                 return __get_rooturi(full_uri)
 
+@timed
 def __get_rooturi(full_uri):
     """Return the root SENSE URI for a given full SENSE URI"""
-    discover_api = DiscoverApi()
+    discover_api = get_discover_api()
     root_uri = discover_api.discover_lookup_rooturi_get(full_uri)
     if not good_response(root_uri):
         raise ValueError(f"Discover query failed for {full_uri}")
     else:
         return root_uri
 
+@timed
 def stage_link(src_uri, dst_uri, src_ipv6, dst_ipv6, instance_uuid="", alias=""):
     """Return the maximum theoretical bandwidth available between two sites
 
     Note: not fully supported by SENSE yet
     """
-    workflow_api = WorkflowCombinedApi()
+    workflow_api = get_workflow_api()
     if instance_uuid == "":
         workflow_api.instance_new()
     else:
         workflow_api.si_uuid = instance_uuid
-    # Create service instance
+    # Query SENSE and extract theoretical bandwidth from its response
+    intent = get_stage_intent(src_uri, dst_uri, src_ipv6, dst_ipv6, alias=alias)
+    response = workflow_api.instance_create(json.dumps(intent))
+    logging.debug(response)
+    return parse_stage_response(response, instance_uuid)
+
+def get_stage_intent(src_uri, dst_uri, src_ipv6, dst_ipv6, alias=""):
+    """Return the intent that creates a service instance and asks for its maximum bandwidth"""
     intent = {
         "service_profile_uuid": get_profile_uuid(),
         "queries": [
@@ -108,9 +244,10 @@ def stage_link(src_uri, dst_uri, src_ipv6, dst_ipv6, instance_uuid="", alias="")
     }
     if alias:
         intent["alias"] = alias
-    # Query SENSE and extract theoretical bandwidth from its response
-    response = workflow_api.instance_create(json.dumps(intent))
-    logging.debug(response)
+    return intent
+
+def parse_stage_response(response, instance_uuid):
+    """Return the service instance UUID and theoretical bandwidth from a staging response"""
     if not good_response(response):
         raise ValueError(f"SENSE query failed for {instance_uuid}")
     else:
@@ -123,12 +260,25 @@ def stage_link(src_uri, dst_uri, src_ipv6, dst_ipv6, instance_uuid="", alias="")
                 else:
                     return response["service_uuid"], float(result["bandwidth"])
 
+@timed
 def provision_link(instance_uuid, src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidth, alias=""):
     """Create a SENSE guaranteed-bandwidth link between two sites"""
-    workflow_api = WorkflowCombinedApi()
+    workflow_api = get_workflow_api()
     workflow_api.si_uuid = instance_uuid
     # Modify service instance
     logging.debug(f"instance uuid: {instance_uuid}")
+    intent = get_provision_intent(src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidth, alias=alias)
+    # Push intent JSON to SENSE
+    response = workflow_api.instance_create(json.dumps(intent))
+    logging.debug(response)
+    if not good_response(response):
+        raise ValueError(f"SENSE query failed for {instance_uuid}")
+    else:
+        response = json.loads(response)
+        workflow_api.instance_operate("provision", sync="true")
+
+def get_provision_intent(src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidth, alias=""):
+    """Return the intent that sets the bandwidth of a staged service instance"""
     intent = {
         "service_profile_uuid": get_profile_uuid(),
         "queries": [
@@ -149,18 +299,21 @@ def provision_link(instance_uuid, src_uri, dst_uri, src_ipv6, dst_ipv6, bandwidt
     }
     if alias:
         intent["alias"] = alias
-    # Push intent JSON to SENSE
-    response = workflow_api.instance_create(json.dumps(intent))
-    logging.debug(response)
-    if not good_response(response):
-        raise ValueError(f"SENSE query failed for {instance_uuid}")
-    else:
-        response = json.loads(response)
-        workflow_api.instance_operate("provision", sync="true")
+    return intent
+
+@timed
+def get_link_status(instance_uuid):
+    """Return the status of a SENSE link, e.g. 'CREATE - READY'"""
+    workflow_api = get_workflow_api()
+    status = workflow_api.instance_get_status(si_uuid=instance_uuid)
+    if "error" in status:
+        raise ValueError(status)
+    return status
 
+@timed
 def delete_link(instance_uuid):
     """Delete a SENSE link"""
-    workflow_api = WorkflowCombinedApi()
+    workflow_api = get_workflow_api()
     status = workflow_api.instance_get_status(si_uuid=instance_uuid)
     logging.debug(status)
     if "error" in status:
@@ -180,6 +333,7 @@ def delete_link(instance_uuid):
     else:
         raise Exception(f"cancel operation disrupted; instance not deleted")
 
+@timed
 def reprovision_link(old_instance_uuid, src_uri, dst_uri, src_ipv6, dst_ipv6, 
                      new_bandwidth, alias=""):
     """Reprovision a SENSE link
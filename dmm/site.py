@@ -1,33 +1,63 @@
-import yaml
 import logging
+from collections import deque
 import dmm.sense_api as sense_api
+from dmm.cache import DiscoveryCache
+from dmm.config import get_config, SiteSection
+import dmm.tracing as tracing
 
 class Site:
-    def __init__(self, rse_name):
+    __slots__ = (
+        "rse_name", "sense_name", "free_ipv6_pool", "used_ipv6_pool", "total_uplink_capacity", 
+        "prio_sums", "all_prios_sum", "ipv6_pool", "default_ipv6", "block_to_ipv6", 
+        "waiting_requests"
+    )
+
+    def __init__(self, rse_name, discovery_cache=None):
         self.rse_name = rse_name
-        self.sense_name = sense_api.get_uri(rse_name, regex=f"^{rse_name}$")
-        self.free_ipv6_pool = []
-        self.used_ipv6_pool = []
-        self.total_uplink_capacity = sense_api.get_uplink_capacity(self.sense_name)
+        # Look up the SENSE discovery results, using the cache if one is given
+        with tracing.span("discover site", rse_name=rse_name):
+            if discovery_cache is not None:
+                discovery = discovery_cache.get(rse_name)
+            else:
+                discovery = DiscoveryCache.discover(rse_name)
+        self.sense_name = discovery["sense_name"]
+        self.free_ipv6_pool = deque()
+        self.used_ipv6_pool = set()
+        # Guaranteed-bandwidth requests waiting for an IPv6 block to be freed at this site
+        self.waiting_requests = deque()
+        self.total_uplink_capacity = discovery["uplink_capacity"]
         self.prio_sums = {}
         self.all_prios_sum = 0
-        # Read site information from config.yaml; should not be needed in the future
-        with open("config.yaml", "r") as f_in:
-            site_config = yaml.safe_load(f_in).get("sites").get(rse_name)
-            if not site_config:
-                logging.error(f"no config for {rse_name} in config.yaml!")
+        # IPv6 blocks that SENSE knows about at this site
+        self.ipv6_pool = discovery["ipv6_pool"]
+        self.load_config()
+
+    def load_config(self):
+        """(Re)load site information from config.yaml; should not be needed in the future"""
+        site_config = get_config().site(self.rse_name)
+        if not site_config:
+            logging.error(f"no config for {self.rse_name} in config.yaml!")
+            site_config = SiteSection({})
 
         # Best effort IPv6 may be extracted from elsewhere in the future
-        self.default_ipv6 = site_config.get("best_effort_ipv6")
+        self.default_ipv6 = site_config.best_effort_ipv6
         # The mapping below is a temporary hack; should not be needed in the future
-        self.block_to_ipv6 = site_config.get("ipv6_pool", {})
+        block_to_ipv6 = dict(site_config.ipv6_pool)
+        for block in self.used_ipv6_pool:
+            # Keep the mapping for blocks in use, even if they were removed from the config
+            if block not in block_to_ipv6:
+                block_to_ipv6[block] = self.block_to_ipv6[block]
+        self.block_to_ipv6 = block_to_ipv6
 
         # Pull configured ipv6 blocks from free pool
-        for block in sense_api.get_ipv6_pool(self.sense_name):
+        self.free_ipv6_pool = deque()
+        for block in self.ipv6_pool:
+            if block in self.used_ipv6_pool:
+                continue
             if block in self.block_to_ipv6 and self.block_to_ipv6[block] != self.default_ipv6:
                 logging.debug(f"added {block} to free pool for {self.rse_name}")
                 self.free_ipv6_pool.append(block)
-                
+
     def add_request(self, partner_name, priority):
         """
         Add request priority to the numerator and denominator of the uplink provisioning 
@@ -69,10 +99,62 @@ class Site:
         self.total_uplink_capacity = sense_api.get_uplink_capacity(self.sense_name)
 
     def reserve_ipv6(self):
-        ipv6 = self.free_ipv6_pool.pop(0)
-        self.used_ipv6_pool.append(ipv6)
+        """Return a free IPv6 block and mark it as used, or None if there is none left"""
+        if not self.free_ipv6_pool:
+            return None
+        ipv6 = self.free_ipv6_pool.popleft()
+        self.used_ipv6_pool.add(ipv6)
         return ipv6
 
     def free_ipv6(self, ipv6):
+        """Return an IPv6 block to the free pool, unless it was removed from config.yaml (or 
+        mapped to the best effort IPv6) while it was in use, in which case it is dropped"""
         self.used_ipv6_pool.remove(ipv6)
+        site_config = get_config().site(self.rse_name) or SiteSection({})
+        address = site_config.ipv6_pool.get(ipv6)
+        if address is None or address == site_config.best_effort_ipv6:
+            logging.info(f"dropped {ipv6} from {self.rse_name}; no longer configured")
+            self.block_to_ipv6.pop(ipv6, None)
+            return
         self.free_ipv6_pool.append(ipv6)
+
+    def claim_ipv6(self, ipv6):
+        """Mark a specific IPv6 block as used, e.g. one that was reserved before a restart; 
+        returns None if it is already in use"""
+        if ipv6 in self.used_ipv6_pool:
+            logging.error(f"cannot claim IPv6 block {ipv6} at {self.rse_name}; already in use")
+            return None
+        if ipv6 in self.free_ipv6_pool:
+            self.free_ipv6_pool.remove(ipv6)
+        self.used_ipv6_pool.add(ipv6)
+        return ipv6
+
+    def admit_waiting_requests(self):
+        """
+        Admit the requests waiting at this site, in order, for as long as it has free IPv6 
+        blocks; returns the requests that were admitted
+
+        Note: a request that gets a block here but none at its other site moves on to 
+              wait at that site instead; each request is only tried once per call, since one 
+              that needs two blocks here (i.e. between this site and itself) can go back to 
+              the end of the queue while a block is still free
+        """
+        admitted = []
+        for _ in range(len(self.waiting_requests)):
+            if not self.free_ipv6_pool:
+                break
+            request = self.waiting_requests.popleft()
+            if request.admit():
+                admitted.append(request)
+        return admitted
+
+    def get_ipv6_occupancy(self):
+        """Return the number of used, free and waited-for IPv6 blocks at this site"""
+        n_used = len(self.used_ipv6_pool)
+        n_free = len(self.free_ipv6_pool)
+        return {
+            "used": n_used,
+            "free": n_free,
+            "waiting": len(self.waiting_requests),
+            "occupancy": n_used/max(n_used + n_free, 1)
+        }
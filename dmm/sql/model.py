@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, BigInteger, Float, Boolean, String, ForeignKey, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 BASE = declarative_base()
@@ -10,3 +10,26 @@ class BaseSchema(BASE):
     destination_url = Column(String(50))
     priority = Column(Integer())
     total_transfer_size = Column(Integer())
+
+class RequestRecord(BASE):
+    """State of a DMM Request, including its SENSE link, as of its last update"""
+    __tablename__ = "DMM_REQUESTS"
+    request_id = Column(String(255), primary_key=True)
+    rule_id = Column(String(255))
+    src_rse_name = Column(String(255))
+    dst_rse_name = Column(String(255))
+    priority = Column(Integer())
+    n_bytes_total = Column(BigInteger())
+    n_bytes_transferred = Column(BigInteger())
+    n_transfers_total = Column(Integer())
+    n_transfers_submitted = Column(Integer())
+    n_transfers_finished = Column(Integer())
+    n_transfer_ids = Column(Integer())
+    waiting = Column(Boolean())
+    link_is_open = Column(Boolean())
+    src_ipv6 = Column(String(255))
+    dst_ipv6 = Column(String(255))
+    bandwidth = Column(Integer())
+    sense_link_id = Column(String(255))
+    theoretical_bandwidth = Column(Float())
+    updated_at = Column(Float())
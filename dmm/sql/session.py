@@ -1,24 +1,37 @@
-from datetime import datetime
 from os import environ as env
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from sql.model import BaseSchema
+from dmm.sql.model import BASE, RequestRecord
 
 
 class SQLSession(object):
-    def __init__(self):
-        self.session = sessionmaker()
-        hostname = env.get("RUCIO_DB_ADDR")
-        _ENGINE = create_engine(f"postgresql://rucio:secret@{hostname}:3306/rucio")
-        self.session.configure(bind=_ENGINE)
-        BaseSchema.metadata.create_all(_ENGINE)
+    def __init__(self, url=None):
+        if url is None:
+            hostname = env.get("RUCIO_DB_ADDR")
+            url = f"postgresql://rucio:secret@{hostname}:3306/rucio"
+        _ENGINE = create_engine(url)
+        self.session = sessionmaker(bind=_ENGINE)
+        BASE.metadata.create_all(_ENGINE)
 
-    def write(self, transfer):
-        self.session.add(transfer)
-        self.session.commit()
+    def write(self, records):
+        """Insert or update the given request records in a single transaction"""
+        with self.session.begin() as session:
+            for record in records:
+                session.merge(RequestRecord(**record))
 
-    def delete(self, transfer):
-        self.session.delete(transfer)
-        self.session.commit()
-        # Add check to make sure entry has been deleted
+    def delete(self, request_ids):
+        """Delete the records of the given requests in a single transaction"""
+        with self.session.begin() as session:
+            session.query(RequestRecord).filter(
+                RequestRecord.request_id.in_(request_ids)
+            ).delete(synchronize_session=False)
+
+    def load(self):
+        """Return every request record as a dictionary"""
+        with self.session() as session:
+            columns = RequestRecord.__table__.columns.keys()
+            return [
+                {column: getattr(record, column) for column in columns}
+                for record in session.query(RequestRecord).all()
+            ]
@@ -0,0 +1,79 @@
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+from dmm.standin.server import StandInServer, StandInHandler
+
+class PrometheusStandIn(StandInServer):
+    """
+    Local stand-in for the Prometheus instant and range query APIs, serving the node exporter metrics 
+    that dmm/prometheus.py queries for every IPv6 address in `sites` (i.e. the sites section 
+    of config.yaml); each device transmits a steady `throughput` bytes/s
+    """
+    def __init__(self, address, sites, throughput=1.25e9, **kwargs):
+        super().__init__(address, PrometheusHandler, **kwargs)
+        self.throughput = throughput
+        # IPv6 address --> (device, instance, job), parsed the same way as by DMM
+        self.devices = {}
+        for rse_name, site in sites.items():
+            for device_i, ipv6 in enumerate(site.get("ipv6_pool", {}).values()):
+                address = ipv6.split("]")[0][1:]
+                self.devices[address] = (f"eth{device_i}", f"{rse_name}-node:9100", rse_name)
+
+class PrometheusHandler(StandInHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if self.inject():
+            return
+        params = parse_qs(url.query)
+        query = params.get("query", [""])[0]
+        if url.path.endswith("/api/v1/query"):
+            query_time = float(params.get("time", [time.time()])[0])
+            self.reply(self.evaluate(query, query_time))
+        elif url.path.endswith("/api/v1/query_range"):
+            start_time = float(params["start"][0])
+            end_time = float(params["end"][0])
+            step = float(params["step"][0])
+            self.reply(self.evaluate_range(query, start_time, end_time, step))
+        else:
+            self.reply({"status": "error", "error": f"{url.path} not found"}, code=404)
+
+    def evaluate_range(self, query, start_time, end_time, step):
+        """Evaluate the range query that DMM sends, i.e. the transmitted bytes counters that 
+        match a selector of label regexes"""
+        match = re.match(r"node_network_transmit_bytes_total\{(.*)\}$", query)
+        if not match:
+            return {"status": "error", "errorType": "bad_data", "error": f"unsupported query {query}"}
+        matchers = {
+            name: re.compile(regex.replace("\\\\", "\\"))
+            for name, regex in re.findall(r'(\w+)=~"((?:[^"\\]|\\.)*)"', match.group(1))
+        }
+        throughput = self.server.throughput
+        n_steps = int((end_time - start_time)//step) + 1
+        times = [start_time + step_i*step for step_i in range(n_steps)]
+        results = []
+        for device, instance, job in self.server.devices.values():
+            labels = {"device": device, "instance": instance, "job": job}
+            if not all(regex.fullmatch(labels[name]) for name, regex in matchers.items()):
+                continue
+            values = [[t, str(throughput*t)] for t in times]
+            results.append({"metric": labels, "values": values})
+        return {"status": "success", "data": {"resultType": "matrix", "result": results}}
+
+    def evaluate(self, query, query_time):
+        """Evaluate the handful of queries that DMM sends"""
+        throughput = self.server.throughput
+        results = []
+        if query == "node_network_address_info":
+            for address, (device, instance, job) in self.server.devices.items():
+                labels = {"address": address, "device": device, "instance": instance, "job": job}
+                results.append({"metric": labels, "value": [query_time, "1"]})
+            return {"status": "success", "data": {"resultType": "vector", "result": results}}
+        match = re.match(r"node_network_transmit_bytes_total\{(.*)\}$", query)
+        if match:
+            labels = dict(re.findall(r'(\w+)=~?"([^"]*)"', match.group(1)))
+            for device, instance, job in self.server.devices.values():
+                if device == labels.get("device") and instance == labels.get("instance"):
+                    labels = {"device": device, "instance": instance, "job": job}
+                    results.append({"metric": labels, "value": [query_time, str(throughput*query_time)]})
+            return {"status": "success", "data": {"resultType": "vector", "result": results}}
+        return {"status": "error", "errorType": "bad_data", "error": f"unsupported query {query}"}
@@ -0,0 +1,133 @@
+import json
+import re
+import time
+import uuid
+from threading import Lock
+from urllib.parse import urlparse, parse_qs, unquote
+from dmm.standin.server import StandInServer, StandInHandler
+
+class SENSEStandIn(StandInServer):
+    """
+    Local stand-in for the subset of the SENSE orchestrator API used by dmm/sense_api.py: 
+    authentication, discovery lookups and service instance create/operate/status/delete
+
+    Every site in `sites` (i.e. the sites section of config.yaml) is known to it, with the 
+    IPv6 blocks listed there; provisioning and cancelling an instance take provision_delay 
+    seconds, during which the instance is not READY
+    """
+    def __init__(self, address, sites, uplink_capacity=100000, max_bandwidth=40000, 
+                 provision_delay=0, **kwargs):
+        super().__init__(address, SENSEHandler, **kwargs)
+        self.sites = sites
+        self.uplink_capacity = uplink_capacity
+        self.max_bandwidth = max_bandwidth
+        self.provision_delay = provision_delay
+        # Instance UUID --> {"phase": str, "state": str, "ready_time": float}
+        self.instances = {}
+        self.lock = Lock()
+
+    def get_status(self, instance_uuid):
+        with self.lock:
+            instance = self.instances.get(instance_uuid)
+            if instance is None:
+                return None
+            if instance["state"] != "READY" and time.time() >= instance["ready_time"]:
+                instance["state"] = "READY"
+            return f"{instance['phase']} - {instance['state']}"
+
+    def operate(self, instance_uuid, action, sync):
+        phase = {"provision": "CREATE", "cancel": "CANCEL", "reprovision": "REINSTATE"}[action]
+        with self.lock:
+            instance = self.instances.get(instance_uuid)
+            if instance is None:
+                return False
+            instance["phase"] = phase
+            instance["state"] = "COMMITTING"
+            instance["ready_time"] = time.time() + self.provision_delay
+        if sync:
+            time.sleep(self.provision_delay)
+        return True
+
+class SENSEHandler(StandInHandler):
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if path.endswith("/auth"):
+            return self.reply({"access_token": uuid.uuid4().hex, "refresh_token": uuid.uuid4().hex})
+        if self.inject():
+            return
+        match = re.match(r".*/instance/([^/]+)$", path)
+        if match:
+            instance_uuid = match.group(1)
+            intent = json.loads(body)
+            with self.server.lock:
+                self.server.instances[instance_uuid] = {
+                    "phase": "CREATE", "state": "COMPILED", "ready_time": 0, "intent": intent
+                }
+            queries = [
+                {"asked": query["ask"], "results": [{"bandwidth": str(self.server.max_bandwidth)}]}
+                for query in intent.get("queries", []) if query["ask"] == "maximum-bandwidth"
+            ]
+            return self.reply({"service_uuid": instance_uuid, "queries": queries})
+        self.reply({"error": f"{path} not found"}, code=404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        if self.inject():
+            return
+        if path.endswith("/instance"):
+            return self.reply(str(uuid.uuid4()), content_type="text/plain")
+        match = re.match(r".*/instance/([^/]+)/status$", path)
+        if match:
+            status = self.server.get_status(match.group(1))
+            if status is None:
+                return self.reply(f"error: unknown instance {match.group(1)}", content_type="text/plain")
+            return self.reply(status, content_type="text/plain")
+        match = re.match(r".*/discover/lookup/(.+)/rooturi$", path)
+        if match:
+            rse_name = match.group(1).split(":")[-2]
+            return self.reply(f"urn:ogf:network:{rse_name}", content_type="text/plain")
+        match = re.match(r".*/discover/lookup/([^/]+)$", path)
+        if match:
+            rse_name = match.group(1)
+            results = []
+            if rse_name in self.server.sites:
+                results.append({
+                    "name/tag/value": rse_name, 
+                    "resource": f"urn:ogf:network:{rse_name}:full"
+                })
+            return self.reply({"results": results})
+        match = re.match(r".*/discover/(.+)/peers$", path)
+        if match:
+            return self.reply({"peer_points": [{"port_capacity": str(self.server.uplink_capacity)}]})
+        match = re.match(r".*/discover/(.+)/ipv6pool$", path)
+        if match:
+            site = self.server.sites.get(match.group(1).split(":")[-1])
+            if site is None:
+                return self.reply("ERROR: unknown domain", content_type="text/plain")
+            ipv6_pool = ",".join(site.get("ipv6_pool", {}))
+            return self.reply({"routing": [{"ipv6_subnet_pool": ipv6_pool}]})
+        self.reply({"error": f"{path} not found"}, code=404)
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        self.read_body()
+        if self.inject():
+            return
+        match = re.match(r".*/instance/([^/]+)/(provision|cancel|reprovision)$", url.path)
+        if match:
+            sync = parse_qs(url.query).get("sync", ["false"])[0] == "true"
+            if self.server.operate(match.group(1), match.group(2), sync):
+                return self.reply("", content_type="text/plain")
+            return self.reply({"error": f"unknown instance {match.group(1)}"}, code=404)
+        self.reply({"error": f"{url.path} not found"}, code=404)
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if self.inject():
+            return
+        instance_uuid = path.rstrip("/").rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.instances.pop(instance_uuid, None)
+        self.reply("", content_type="text/plain")
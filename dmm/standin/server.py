@@ -0,0 +1,63 @@
+import json
+import random
+import socket
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server for a local stand-in of a service that DMM talks to; every response is 
+    delayed by `latency` seconds (plus up to `jitter` seconds), and fails with a 500 
+    error with probability `error_rate`
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, handler_class, latency=0, jitter=0, error_rate=0):
+        super().__init__(address, handler_class)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.n_requests = 0
+        self.n_errors = 0
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler with the helpers shared by the stand-in servers"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Send small responses right away instead of waiting for the client's ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def inject(self):
+        """Apply the configured latency; return True if this request should fail instead"""
+        self.server.n_requests += 1
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.server.error_rate:
+            self.server.n_errors += 1
+            self.reply({"error": "injected failure"}, code=500)
+            return True
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def reply(self, body, code=200, content_type="application/json"):
+        if isinstance(body, bytes):
+            data = body
+        elif isinstance(body, str):
+            data = body.encode()
+        else:
+            data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
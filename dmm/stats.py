@@ -0,0 +1,92 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+
+class Histogram:
+    """
+    Distribution of observed durations (in seconds), binned into the cumulative buckets of 
+    a Prometheus histogram
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=BUCKETS):
+        self.lock = Lock()
+        self.buckets = buckets
+        # Number of observations in each bucket, plus one for those above the last bound
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Return the cumulative count at each upper bound (the last one being +Inf), the 
+        sum of all observations and their number"""
+        with self.lock:
+            cumulative = []
+            n_observed = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                n_observed += count
+                cumulative.append((upper_bound, n_observed))
+            return cumulative, self.sum, self.count
+
+class HandlerStats:
+    """Track the queue depth and latency of the handlers for one Rucio daemon"""
+    def __init__(self):
+        self.lock = Lock()
+        self.n_queued = 0
+        self.n_active = 0
+        self.n_handled = 0
+        self.total_wait = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.last_latency = 0
+        # Distributions of the time spent waiting for a handler and in the handler
+        self.wait = Histogram()
+        self.latency = Histogram()
+
+    def queue(self):
+        """Record a new message waiting for a handler; return its arrival time"""
+        with self.lock:
+            self.n_queued += 1
+        return time.time()
+
+    def start(self, arrival_time):
+        """Record that a handler picked up a message that arrived at arrival_time"""
+        now = time.time()
+        with self.lock:
+            self.n_queued -= 1
+            self.n_active += 1
+            self.total_wait += now - arrival_time
+        self.wait.observe(now - arrival_time)
+        return now
+
+    def finish(self, start_time):
+        """Record that a handler started at start_time has returned"""
+        latency = time.time() - start_time
+        with self.lock:
+            self.n_active -= 1
+            self.n_handled += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.last_latency = latency
+        self.latency.observe(latency)
+        return latency
+
+    def summary(self):
+        """Return a snapshot of the queue depth and handler latencies (in seconds)"""
+        with self.lock:
+            n_handled = max(self.n_handled, 1)
+            return {
+                "queued": self.n_queued,
+                "active": self.n_active,
+                "handled": self.n_handled,
+                "avg_wait": self.total_wait/n_handled,
+                "avg_latency": self.total_latency/n_handled,
+                "max_latency": self.max_latency,
+                "last_latency": self.last_latency
+            }
@@ -0,0 +1,126 @@
+import json
+import os
+import time
+import logging
+import threading
+from threading import Lock
+
+TRACER = None
+TRACER_LOCK = Lock()
+
+class NullSpan:
+    """Span handed out while tracing is off; entering and exiting it does nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start_time")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.complete(self.name, self.start_time, time.perf_counter(), self.args)
+        return False
+
+class Tracer:
+    """
+    Writes spans and instant events to a file in the Chrome trace event format, which can
+    be opened with Perfetto (ui.perfetto.dev) or chrome://tracing; each thread is shown as
+    its own track
+
+    Note: events are appended as they happen, without the closing bracket of the JSON
+          array, which both viewers accept; a trace is readable even if DMM is killed
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.named_threads = set()
+        self.closed = False
+        self.f_out = open(path, "w")
+        self.f_out.write("[\n")
+
+    def __emit(self, event):
+        thread = threading.current_thread()
+        event["pid"] = self.pid
+        event["tid"] = thread.ident
+        with self.lock:
+            if self.closed:
+                return
+            if thread.ident not in self.named_threads:
+                self.named_threads.add(thread.ident)
+                metadata = {
+                    "name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident,
+                    "args": {"name": thread.name}
+                }
+                self.f_out.write(json.dumps(metadata) + ",\n")
+            self.f_out.write(json.dumps(event, default=str) + ",\n")
+
+    def complete(self, name, start_time, end_time, args):
+        """Record a span that ran from start_time to end_time (perf_counter seconds)"""
+        self.__emit({
+            "name": name, "ph": "X",
+            "ts": 1e6*(start_time - self.origin), "dur": 1e6*(end_time - start_time),
+            "args": args
+        })
+
+    def instant(self, name, args):
+        self.__emit({
+            "name": name, "ph": "i", "s": "t",
+            "ts": 1e6*(time.perf_counter() - self.origin),
+            "args": args
+        })
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.f_out.close()
+
+def start_tracing(path):
+    """Start writing spans to a trace file; returns False if tracing is already on"""
+    global TRACER
+    with TRACER_LOCK:
+        if TRACER is not None:
+            return False
+        TRACER = Tracer(path)
+    logging.info(f"tracing to {path}")
+    return True
+
+def stop_tracing():
+    global TRACER
+    with TRACER_LOCK:
+        tracer, TRACER = TRACER, None
+    if tracer is not None:
+        tracer.close()
+        logging.info(f"stopped tracing to {tracer.path}")
+
+def span(name, **args):
+    """Return a context manager that traces the code it wraps as a span, if tracing is on"""
+    tracer = TRACER
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, args)
+
+def instant(name, **args):
+    """Trace a point in time, if tracing is on"""
+    tracer = TRACER
+    if tracer is not None:
+        tracer.instant(name, args)